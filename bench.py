@@ -0,0 +1,506 @@
+#!/usr/bin/env python
+
+"""
+bench.py - Benchmarks for nuvigc.py.
+
+Given a GSAK database name, compare the text cleanup functions in nuvigc.py
+with the original implementations they replaced. The benchmarks run on the
+cache descriptions, hints and logs of the database, prepared the same way
+processCache prepares them. It also writes the database as GPX and as GPI,
+checks the structure of the GPI file and that it has the same points as the
+GPX file.
+
+With --scales, generate synthetic databases of several sizes with gendb.py
+instead and time process_db end to end as well as the hot functions on
+each of them. The results can be saved and compared with an earlier run to
+spot regressions.
+"""
+
+import sys
+import os
+import re
+import time
+import json
+import platform
+import shutil
+import struct
+import tempfile
+import xml.etree.cElementTree as ElementTree
+from HTMLParser import HTMLParser, HTMLParseError
+from optparse import OptionParser
+import nuvigc
+import gendb
+import gsakdb
+import gpiwriter
+
+def cleanStrChain(s):
+    """
+    The original cleanStr, one re.sub pass per substitution. Kept as a
+    reference for checking and timing the single-pass cleanStr.
+    """
+    s = re.sub(r'\s+', ' ', s)
+    s = re.sub(r'"', '&quot;', s)
+    s = re.sub(r'<', '&lt;', s)
+    s = re.sub(r'>', '&gt;', s)
+
+    s = re.sub(r'&ndash;', '-', s)
+    s = re.sub(r'&mdash;', '-', s)
+    s = re.sub(r'&nbsp;', ' ', s)
+    s = re.sub(r'&ldquo;', '&quot;', s)
+    s = re.sub(r'&rdquo;', '&quot;', s)
+    s = re.sub(r'&lsquo;', "'", s)
+    s = re.sub(r'&rsquo;', "'", s)
+    s = re.sub(r'&trade;', '(TM)', s)
+
+    s = re.sub(r'&(\w+);', lambda m: nuvigc.entity_repl(m.group(1)), s)
+
+    s = re.sub(r'&#8216;', "'", s)
+    s = re.sub(r'&#8217;', "'", s)
+    s = re.sub(r'&#8220;', '&quot;', s)
+    s = re.sub(r'&#8221;', '&quot;', s)
+    s = re.sub(r'&#8211;', '-', s)
+    s = re.sub(r'&#8212;', '-', s)
+
+    s = re.sub(r'\x00', '', s)
+
+    s = re.sub(r'&#(\d+);', lambda m: nuvigc.entity_num_repl(m.group(1)), s)
+
+    return s
+
+class StripHTMLParser(HTMLParser):
+    """
+    The original HTMLParser-based HTML stripper. Kept as a reference for
+    checking and timing stripHTML.
+    """
+    def __init__(self):
+	self.reset()
+	self.text = ''
+
+    def handle_data(self, d):
+	d = re.sub(r'\r', r'', d)
+	d = re.sub(r'\n', r'<br>', d)
+	self.text += d
+
+    def handle_starttag(self, tag, attrs):
+	if tag == 'p' or tag == 'br':
+	    self.text += '<%s>' % tag
+
+    def handle_startendtag(self, tag, attrs):
+	if tag == 'br':
+	    self.text += '<%s>' % tag
+
+    def handle_endtag(self, tag):
+	if tag == 'p':
+	    self.text += '</%s>' % tag
+
+    def handle_entityref(self, name):
+	if name == 'ndash' or name == 'mdash':
+	    self.text += '-'
+	elif name == 'nbsp':
+	    self.text += ' '
+	elif name == 'ldquo' or name == 'rdquo':
+	    self.text += '&quot;'
+	elif name == 'lsquo' or name == 'rsquo':
+	    self.text += "'"
+	elif name == 'trade':
+	    self.text += '(TM)'
+	elif name == 'quot' or name == 'lt' or name == 'gt' or name == 'amp':
+	    self.text += '&%s;' % name
+	else:
+	    self.text += '(%s)' % name
+
+    def handle_charref(self, name):
+	if name == '8216' or name == '8217':
+	    self.text += "'"
+	elif name == '8220' or name == '8221':
+	    self.text += '&quot;'
+	elif name == '8211' or name == '8212':
+	    self.text += '-'
+	else:
+	    self.text += nuvigc.entity_num_repl(name)
+
+    def unknown_decl(self, decl):
+	pass
+
+def cleanHTMLParser(s):
+    """
+    The original cleanHTML, using StripHTMLParser.
+    """
+    stripper = StripHTMLParser()
+    try:
+	stripper.feed(s)
+    except HTMLParseError:
+	# The original simple cleanup, not nuvigc.cleanHTML, so that the
+	# check in bench_cleanhtml still compares two implementations.
+	s = re.sub(r'&', r'&amp;', s)
+	s = re.sub(r'<', r'[', s)
+	s = re.sub(r'>', r']', s)
+	return s
+    return stripper.text
+
+def cleanHTMLInputs(conn, limit):
+    """
+    Collect the strings that processCache and logFmt pass to cleanHTML:
+    descriptions and log texts.
+    """
+    curs = conn.cursor()
+    curs.execute('select * from cachememo limit ?', (limit, ))
+    inputs = []
+    for row in curs:
+	desc = nuvigc.dec(row['ShortDescription']) + '<br>' + \
+		nuvigc.dec(row['LongDescription'])
+	inputs.append(nuvigc.escAmp(nuvigc.enc(desc)))
+    curs.execute('select lText from logmemo limit ?', (limit * 10, ))
+    for row in curs:
+	inputs.append(nuvigc.enc(nuvigc.escAmp(nuvigc.dec(row[0]))))
+    return inputs
+
+def cleanStrInputs(conn, limit):
+    """
+    Collect the strings that processCache passes to cleanStr: cleaned-up
+    descriptions, hints and logs.
+    """
+    curs = conn.cursor()
+    curs.execute('select * from cachememo limit ?', (limit, ))
+    inputs = []
+    for row in curs:
+	desc = nuvigc.dec(row['ShortDescription']) + '<br>' + \
+		nuvigc.dec(row['LongDescription'])
+	inputs.append(nuvigc.cleanHTML(nuvigc.escAmp(nuvigc.enc(desc))))
+	inputs.append("<font color=#008000>Hint: %s</font><br>" %
+		nuvigc.enc(nuvigc.escAmp(nuvigc.dec(row['Hints']))))
+    curs.execute('select lText from logmemo limit ?', (limit * 10, ))
+    for row in curs:
+	inputs.append(nuvigc.cleanHTML(nuvigc.enc(nuvigc.escAmp(
+	    nuvigc.dec(row[0])))))
+    return inputs
+
+def timeFunc(func, inputs, repeat, setup=None):
+    """
+    Time func over all inputs. Returns the best of repeat runs in seconds.
+    If given, setup is called before each run, outside the timing.
+    """
+    best = None
+    for i in range(repeat):
+	if setup is not None:
+	    setup()
+	start = time.time()
+	for s in inputs:
+	    func(s)
+	elapsed = time.time() - start
+	if best is None or elapsed < best:
+	    best = elapsed
+    return best
+
+def bench_cleanhtml(conn, options):
+    inputs = cleanHTMLInputs(conn, options.limit)
+    nbytes = sum([len(s) for s in inputs])
+
+    for s in inputs:
+	if cleanHTMLParser(s) != nuvigc.cleanHTML(s):
+	    print >> sys.stderr, 'cleanHTML output differs for %r' % s[:200]
+	    sys.exit(3)
+
+    old = timeFunc(cleanHTMLParser, inputs, options.repeat)
+    new = timeFunc(nuvigc.cleanHTML, inputs, options.repeat)
+    print 'cleanHTML: %d strings, %d KB' % (len(inputs), nbytes / 1024)
+    print '  HTMLParser:   %8.3f s' % old
+    print '  stripHTML:    %8.3f s (%.1fx)' % (new, old / new)
+
+def bench_cleanstr(conn, options):
+    inputs = cleanStrInputs(conn, options.limit)
+    nbytes = sum([len(s) for s in inputs])
+
+    for s in inputs:
+	if cleanStrChain(s) != nuvigc.cleanStr(s):
+	    print >> sys.stderr, 'cleanStr output differs for %r' % s[:200]
+	    sys.exit(3)
+
+    old = timeFunc(cleanStrChain, inputs, options.repeat)
+    new = timeFunc(nuvigc.cleanStr, inputs, options.repeat)
+    print 'cleanStr: %d strings, %d KB' % (len(inputs), nbytes / 1024)
+    print '  re.sub chain: %8.3f s' % old
+    print '  single pass:  %8.3f s (%.1fx)' % (new, old / new)
+
+def readGPIString(data, offset):
+    """
+    Read a string from gpiwriter.string at offset. Returns the string and
+    the offset after it.
+    """
+    total, lang, size = struct.unpack_from('<I2sH', data, offset)
+    if lang != 'EN' or total != size + 4:
+	raise ValueError('bad string at %d' % offset)
+    return data[offset + 8:offset + 8 + size], offset + 8 + size
+
+def walkGPI(data, offset, end, points, bounds=None):
+    """
+    Check the records of a GPI file from offset to end: each one has to
+    fit in the record that holds it, the data of a record with records of
+    its own must fit in its length, and its records must take up exactly
+    the rest. The points of an area must lie within its bounds, given as
+    north, east, south, west. Adds the position and name of each point
+    to points. Raises ValueError on the first problem.
+    """
+    while offset < end:
+	rtype, flags, length = struct.unpack_from('<HHI', data, offset)
+	if flags & gpiwriter.HasRecords:
+	    datalen, = struct.unpack_from('<I', data, offset + 8)
+	    start = offset + 12
+	else:
+	    datalen = length
+	    start = offset + 8
+	stop = start + length
+	if datalen > length or stop > end:
+	    raise ValueError('record %d at %d does not fit' % (rtype, offset))
+	sub = start + datalen
+	if rtype == gpiwriter.PointRecord:
+	    lat, lon = struct.unpack_from('<ii', data, start)
+	    name, pos = readGPIString(data, start + 11)
+	    if pos != sub:
+		raise ValueError('bad point record at %d' % offset)
+	    if bounds is not None and not (bounds[2] <= lat <= bounds[0] and
+		    bounds[3] <= lon <= bounds[1]):
+		raise ValueError('point at %d is outside its area' % offset)
+	    points.append((lat, lon, name))
+	    walkGPI(data, sub, stop, [])
+	elif rtype == gpiwriter.AreaRecord:
+	    walkGPI(data, sub, stop, points,
+		    struct.unpack_from('<iiii', data, start))
+	elif rtype == gpiwriter.EndRecord:
+	    if length or stop != len(data):
+		raise ValueError('end record at %d is not at the end' % offset)
+	else:
+	    walkGPI(data, sub, stop, points, bounds)
+	offset = stop
+    if offset != end:
+	raise ValueError('records end at %d instead of %d' % (offset, end))
+
+def gpxPoints(fname):
+    """
+    Get the position and name of each waypoint in a GPX file, as walkGPI
+    gets them from a GPI file.
+    """
+    points = []
+    for event, elem in ElementTree.iterparse(fname):
+	if elem.tag.endswith('}wpt'):
+	    name = elem.findtext('{%s}name' % elem.tag[1:elem.tag.index('}')])
+	    points.append((gpiwriter.semicircles(float(elem.get('lat'))),
+		gpiwriter.semicircles(float(elem.get('lon'))),
+		name.encode('cp1252', 'replace')))
+	    elem.clear()
+    return points
+
+def bench_gpi(dbname, options):
+    outdir = tempfile.mkdtemp()
+    try:
+	old = timeProcessDb(dbname, options.gsakfolder, 1, outdir=outdir)
+	new = timeProcessDb(dbname, options.gsakfolder, 1, outdir=outdir,
+		gpi=True)
+	gpxname = '%s/%s GSAK.gpx' % (outdir, dbname)
+	gpiname = '%s/%s GSAK.gpi' % (outdir, dbname)
+	data = open(gpiname, 'rb').read()
+	points = []
+	try:
+	    walkGPI(data, 0, len(data), points)
+	except (ValueError, struct.error), e:
+	    print >> sys.stderr, 'GPI file is malformed: %s' % e
+	    sys.exit(3)
+	if sorted(points) != sorted(gpxPoints(gpxname)):
+	    print >> sys.stderr, 'GPI points differ from GPX waypoints'
+	    sys.exit(3)
+	gpxsize = os.path.getsize(gpxname)
+    finally:
+	shutil.rmtree(outdir)
+
+    print 'GPI: %d points, %d KB (GPX %d KB)' % (len(points),
+	    len(data) / 1024, gpxsize / 1024)
+    print '  GPX output:   %8.3f s' % old
+    print '  GPI output:   %8.3f s' % new
+
+def timeProcessDb(dbname, gsakdir, repeat, outdir=None, **kwargs):
+    """
+    Time process_db on a whole database, without its progress output,
+    with the options in kwargs. Returns the best of repeat runs in
+    seconds. The output is left in outdir if given.
+    """
+    keep = outdir is not None
+    if not keep:
+	outdir = tempfile.mkdtemp()
+    stdout = sys.stdout
+    best = None
+    try:
+	for i in range(repeat):
+	    sys.stdout = open(os.devnull, 'w')
+	    start = time.time()
+	    nuvigc.process_db(dbname, dbname, outdir, gsakdir, **kwargs)
+	    elapsed = time.time() - start
+	    sys.stdout.close()
+	    sys.stdout = stdout
+	    if best is None or elapsed < best:
+		best = elapsed
+    finally:
+	sys.stdout = stdout
+	if not keep:
+	    shutil.rmtree(outdir)
+    return best
+
+def timeFunctions(dbfile, lookups, options):
+    """
+    Time the hot functions of nuvigc.py on the first options.limit caches
+    of a database. Returns a dict of function name and seconds.
+    """
+    conv = nuvigc.Converter(dbfile, lookups)
+    conn = conv.conn
+    curs = conn.cursor()
+    curs.execute(nuvigc.columns('caches', nuvigc.CacheColumns) +
+	    ' limit ?', (options.limit, ))
+    rows = curs.fetchall()
+    codes = [row['Code'] for row in rows]
+
+    def setup():
+	# Start each run with empty prefetch tables and log text cache,
+	# but load the prefetched tables before timing.
+	conv.initPrefetch()
+	conv.processCache(rows[0])
+
+    results = {}
+    results['cleanStr'] = timeFunc(nuvigc.cleanStr,
+	    cleanStrInputs(conn, options.limit), options.repeat)
+    results['cleanHTML'] = timeFunc(nuvigc.cleanHTML,
+	    cleanHTMLInputs(conn, options.limit), options.repeat)
+    results['logs'] = timeFunc(lambda code: conv.logs(code, nuvigc.TextLimit),
+	    codes, options.repeat, setup)
+    results['attribs'] = timeFunc(conv.attribs, codes, options.repeat,
+	    setup)
+    results['processCache'] = timeFunc(conv.processCache, rows,
+	    options.repeat, setup)
+    conv.close()
+    return results
+
+SuiteColumns = ['processCache', 'logs', 'attribs', 'cleanHTML', 'cleanStr']
+
+def run_suite(options):
+    """
+    Generate synthetic databases at each scale, unless they are already
+    there, and time them. Returns the results by scale.
+    """
+    os.environ['APPDATA'] = os.path.abspath(options.workdir)
+    os.environ['ProgramFiles'] = os.path.abspath(options.workdir)
+    os.environ.pop('ProgramFiles(x86)', None)
+    staticfile = gsakdb.staticPath(options.gsakfolder)
+    if not os.path.exists(staticfile):
+	if not os.path.isdir(os.path.dirname(staticfile)):
+	    os.makedirs(os.path.dirname(staticfile))
+	gendb.writeStatic(staticfile)
+    lookups = nuvigc.load_lookups(options.gsakfolder)
+
+    results = {}
+    for scale in options.scales.split(','):
+	scale = int(scale)
+	dbname = 'bench-%d' % scale
+	dbfile = gsakdb.dbPath(options.gsakfolder, dbname)
+	if not os.path.exists(dbfile):
+	    print 'Generating %s...' % dbname
+	    os.makedirs(os.path.dirname(dbfile))
+	    gendb.generate(dbfile, scale)
+
+	print 'Timing %s...' % dbname
+	result = timeFunctions(dbfile, lookups, options)
+	for dbprofile in options.dbprofiles.split(','):
+	    result[profileColumn(dbprofile)] = timeProcessDb(dbname,
+		    options.gsakfolder, options.repeat, dbprofile=dbprofile)
+	results[str(scale)] = result
+    return results
+
+def profileColumn(dbprofile):
+    """
+    Name the process_db result for a database profile.
+    """
+    if dbprofile == 'default':
+	return 'process_db'
+    return 'process_db/%s' % dbprofile
+
+def show_results(results, baseline, dbprofiles):
+    """
+    Print a table of results, with the ratio to the baseline results for
+    the same scale and function if there are any.
+    """
+    columns = [profileColumn(p) for p in dbprofiles.split(',')] + \
+	    SuiteColumns
+    widths = [max(16, len(c) + 2) for c in columns]
+    print '%8s' % 'caches' + ''.join(['%*s' % (w, c)
+	for w, c in zip(widths, columns)])
+    for scale in sorted(results, key=int):
+	line = '%8s' % scale
+	for w, c in zip(widths, columns):
+	    t = results[scale].get(c)
+	    old = baseline.get(scale, {}).get(c)
+	    if t is None:
+		line += '%*s' % (w, '-')
+	    elif old:
+		line += '%*s' % (w, '%.3f (%.2fx)' % (t, t / old))
+	    else:
+		line += '%*.3f' % (w, t)
+	print line
+
+def main():
+    parser = OptionParser(usage = 'usage: %prog [options] [dbname]')
+    parser.add_option('-g', '--gsak-folder', dest='gsakfolder', default='gsak',
+	    help='GSAK folder name.')
+    parser.add_option('-n', '--limit', dest='limit', type='int', default=2000,
+	    help='Number of caches to take descriptions from.')
+    parser.add_option('-r', '--repeat', dest='repeat', type='int', default=3,
+	    help='Number of timing runs. The best one is reported.')
+    parser.add_option('-s', '--scales', dest='scales',
+	    help='Comma-separated numbers of caches. Run the benchmark suite '
+	    'on synthetic databases of these sizes.')
+    parser.add_option('-w', '--work-dir', dest='workdir', default='bench-data',
+	    help='Where to keep the synthetic databases. Default: %default.')
+    parser.add_option('-p', '--db-profiles', dest='dbprofiles',
+	    default='default',
+	    help='Comma-separated SQLite tuning profiles to time process_db '
+	    'with, out of %s. Default: %%default.' %
+	    ', '.join(sorted(gsakdb.Profiles)))
+    parser.add_option('-o', '--output', dest='output',
+	    help='Save the suite results to this JSON file.')
+    parser.add_option('-c', '--compare', dest='compare',
+	    help='Compare the suite results with those in this JSON file. '
+	    'Times are shown as a ratio to those.')
+
+    (options, args) = parser.parse_args()
+
+    if options.scales:
+	baseline = {}
+	if options.compare:
+	    baseline = json.load(open(options.compare))['results']
+	results = run_suite(options)
+	show_results(results, baseline, options.dbprofiles)
+	if options.output:
+	    f = open(options.output, 'w')
+	    json.dump({
+		'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'sqlite': nuvigc.sqlite3.sqlite_version,
+		'limit': options.limit,
+		'results': results,
+		}, f, indent=1, sort_keys=True)
+	    f.close()
+	return
+
+    if len(args) != 1:
+	parser.print_help()
+	sys.exit(1)
+
+    dbfile = gsakdb.dbPath(options.gsakfolder, args[0])
+    conn = nuvigc.open_db(dbfile)
+
+    bench_cleanhtml(conn, options)
+    bench_cleanstr(conn, options)
+    bench_gpi(args[0], options)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:set tw=0:
@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+"""
+fileutil.py - Helpers for files that are written in one go.
+"""
+
+import sys
+import os
+
+def replaceFile(src, dst):
+    """
+    Rename src to dst, replacing dst if it exists. os.rename does that
+    atomically on POSIX but refuses to replace an existing file on
+    Windows.
+    """
+    if sys.platform == 'win32':
+	import ctypes
+	MOVEFILE_REPLACE_EXISTING = 1
+	if not ctypes.windll.kernel32.MoveFileExW(unicode(src), unicode(dst),
+		MOVEFILE_REPLACE_EXISTING):
+	    raise ctypes.WinError()
+    else:
+	os.rename(src, dst)
+
+# vim:set tw=0:
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+"""
+fragcache.py - Persistent store for rendered GPX fragments.
+
+nuvigc.py keeps the <wpt> block it generated for each cache and waypoint
+here, along with a fingerprint of the data it was generated from. On the
+next run, blocks whose fingerprint has not changed are reused instead of
+being rendered again. GPI point records are kept the same way, as binary
+data.
+"""
+
+import sqlite3
+
+class FragmentCache:
+    """
+    Fragments are stored by kind ('caches' or 'waypoints') and key (the
+    cache or waypoint code). If binary is true, fragments are byte strings
+    that may not be text.
+    """
+    def __init__(self, fname, binary=False):
+	self.binary = binary
+	self.conn = sqlite3.connect(fname)
+	self.conn.execute("""create table if not exists fragments (
+	    kind text, key text, fingerprint text, fragment text,
+	    primary key (kind, key))""")
+	self.hits = 0
+	self.misses = 0
+	self.evicted = 0
+	# (kind, key) of every fragment asked for or stored.
+	self.used = set()
+
+    def fingerprints(self, kind):
+	"""
+	Get the fingerprints of all stored fragments of one kind.
+	"""
+	curs = self.conn.cursor()
+	curs.execute('select key, fingerprint from fragments where kind = ?',
+		(kind, ))
+	return dict(curs.fetchall())
+
+    def get(self, kind, key):
+	curs = self.conn.cursor()
+	curs.execute(
+		'select fragment from fragments where kind = ? and key = ?',
+		(kind, key))
+	row = curs.fetchone()
+	curs.close()
+	self.used.add((kind, key))
+	self.hits += 1
+	if self.binary:
+	    return str(row[0])
+	return row[0]
+
+    def put(self, kind, key, fingerprint, fragment):
+	if self.binary:
+	    fragment = sqlite3.Binary(fragment)
+	self.conn.execute('insert or replace into fragments values (?,?,?,?)',
+		(kind, key, fingerprint, fragment))
+	self.used.add((kind, key))
+	self.misses += 1
+
+    def evictUnused(self):
+	"""
+	Remove the fragments that have not been asked for or stored since
+	the cache was opened, those of caches and waypoints that are gone
+	from the databases.
+	"""
+	gone = [row for row in
+		self.conn.execute('select kind, key from fragments')
+		if row not in self.used]
+	self.conn.executemany(
+		'delete from fragments where kind = ? and key = ?', gone)
+	self.evicted += len(gone)
+
+    def close(self):
+	self.conn.commit()
+	self.conn.close()
+
+# vim:set tw=0:
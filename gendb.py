@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+gendb.py - Generate a synthetic GSAK database for testing and benchmarking
+nuvigc without a real GSAK install.
+
+The database has the tables and columns that nuvigc reads, filled with
+random but repeatable data. The number of caches, the number of logs per
+cache, the size of descriptions, the amount of HTML and the amount of
+non-ASCII text can all be set. Optionally, a static.db3 with the lookup
+table that matches the generated cache types and attributes is written as
+well.
+"""
+
+import sqlite3
+import os
+import sys
+import random
+from optparse import OptionParser
+
+# GSAK cache type codes and names.
+CacheTypeNames = {
+    'A':'Project APE',
+    'B':'Letterbox',
+    'C':'Cache In Trash Out',
+    'E':'Event',
+    'G':'Benchmark',
+    'I':'Wherigo',
+    'L':'Locationless',
+    'M':'Multi',
+    'O':'Other',
+    'R':'Earth',
+    'T':'Traditional',
+    'U':'Unknown',
+    'V':'Virtual',
+    'W':'Webcam',
+    'X':'Maze',
+    'Z':'Mega Event',
+}
+
+# Roughly how common each cache type is.
+CacheTypeWeights = [('T', 60), ('M', 12), ('U', 15), ('V', 2), ('E', 3),
+	('R', 3), ('B', 2), ('W', 1), ('C', 1), ('I', 1)]
+
+AttributeNames = {
+    1:'Dogs', 2:'Access or parking fee', 3:'Climbing gear', 4:'Boat',
+    5:'Scuba gear', 6:'Recommended for kids', 7:'Takes less than an hour',
+    8:'Scenic view', 9:'Significant hike', 10:'Difficult climbing',
+    11:'May require wading', 12:'May require swimming',
+    13:'Available at all times', 14:'Recommended at night',
+    15:'Available during winter', 17:'Poison plants',
+    18:'Dangerous animals', 19:'Ticks', 20:'Abandoned mines',
+    21:'Cliff / falling rocks', 22:'Hunting', 23:'Dangerous area',
+    24:'Wheelchair accessible', 25:'Parking available',
+    26:'Public transportation', 27:'Drinking water nearby',
+    28:'Public restrooms nearby', 29:'Telephone nearby',
+    30:'Picnic tables nearby', 31:'Camping available', 32:'Bicycles',
+    33:'Motorcycles', 34:'Quads', 35:'Off-road vehicles',
+    36:'Snowmobiles', 37:'Horses', 38:'Campfires', 39:'Thorns',
+    40:'Stealth required', 41:'Stroller accessible',
+    42:'Needs maintenance', 43:'Watch for livestock', 44:'Flashlight required',
+    46:'Truck Driver/RV', 47:'Field Puzzle', 48:'UV Light Required',
+    49:'Snowshoes', 50:'Cross Country Skis', 51:'Special Tool Required',
+    52:'Night Cache', 53:'Park and Grab', 54:'Abandoned Structure',
+    55:'Short hike (less than 1km)', 56:'Medium hike (1km-10km)',
+    57:'Long Hike (+10km)', 58:'Fuel Nearby', 59:'Food Nearby',
+    60:'Wireless Beacon', 62:'Seasonal Access', 63:'Tourist Friendly',
+    64:'Tree Climbing', 65:'Front Yard (Private Residence)',
+    66:'Teamwork Required', 67:'GeoTour',
+}
+
+Containers = ['Micro', 'Small', 'Regular', 'Large', 'Other', 'Not chosen',
+	'Virtual']
+
+LogTypes = [('Found it', 70), ("Didn't find it", 10), ('Write note', 10),
+	('Owner Maintenance', 3), ('Needs Maintenance', 2), ('Attended', 2),
+	('Webcam Photo Taken', 1), ('Temporarily Disable Listing', 1),
+	('Enable Listing', 1)]
+
+WaypointTypes = ['Parking Area', 'Final Location', 'Question to Answer',
+	'Stages of a Multicache', 'Trailhead', 'Reference Point']
+
+Words = u'''the a cache is hidden near big old tree rock wall behind under
+bridge path trail park bench log book container camo pencil bring your own
+pen please replace as found thanks for hide TFTC TNLN quick grab nice walk
+muggles were everywhere had to come back later GZ coords are spot on
+hint helped eventually signed swag left took travel bug'''.split()
+
+# Words with non-ASCII characters: accented Latin, typographic quotes and
+# dashes, Greek, Cyrillic, CJK.
+UnicodeWords = u'''café naïve façade über Straße señal
+’quoted’ “quoted” – — … °C ±5m
+γειά привет 中文
+日本語 안녕 ½'''.split()
+
+# HTML as it shows up in cache descriptions and logs, from tidy markup to
+# the kind of mess that trips up HTML parsers.
+TidyHTML = [u'<p>', u'</p>', u'<br>', u'<br />', u'<b>', u'</b>',
+	u'<i>', u'</i>', u'&nbsp;', u'&amp;', u'&quot;', u'&ndash;',
+	u'&mdash;', u'&#8217;', u'&#8220;', u'&#8221;', u'&trade;',
+	u'<font color="#008000">', u'</font>', u'<span style="color: red">',
+	u'</span>', u'<a href="http://example.com/?a=1&amp;b=2">link</a>',
+	u'<img src="http://example.com/img.jpg" alt="spoiler" />',
+	u'<div align="center">', u'</div>', u'<ul><li>', u'</li></ul>',
+	u'\r\n', u'\n']
+MessyHTML = [u'<!-- comment -->', u'<script type="text/javascript">'
+	u'var a = "<b>"; if (a < b) {}</script>', u'<style>p { a: b }</style>',
+	u'<table border=1><tr><td>', u'</td></tr></table>', u'&copy;',
+	u'&foo;', u'&', u'a < b', u'a > b', u'&#x2019;', u'&#39;',
+	u'<P ALIGN=center>', u'<BR>', u'<![CDATA[ x ]]>', u'<!DOCTYPE html>',
+	u'<?xml version="1.0"?>', u'<a href=\'x\'>', u'</a>', u'\t', u'\x00',
+	u'<center>', u'</center>']
+
+class TextMaker:
+    """
+    Make random text. html and uni are the fractions of tokens that are
+    HTML and non-ASCII words.
+    """
+    def __init__(self, rand, html, uni):
+	self.rand = rand
+	self.html = html
+	self.uni = uni
+
+    def text(self, length):
+	"""
+	Make about length characters of text.
+	"""
+	rand = self.rand
+	out = []
+	n = 0
+	while n < length:
+	    x = rand.random()
+	    if x < self.html:
+		if rand.random() < 0.2:
+		    s = rand.choice(MessyHTML)
+		else:
+		    s = rand.choice(TidyHTML)
+	    elif x < self.html + self.uni:
+		s = rand.choice(UnicodeWords)
+	    else:
+		s = rand.choice(Words)
+	    out.append(s)
+	    n += len(s) + 1
+	return u' '.join(out)
+
+    def size(self, mean):
+	"""
+	Pick a random text size. Most texts are short but a few are much
+	longer than the mean.
+	"""
+	return int(self.rand.expovariate(1.0 / mean)) + 1 if mean > 0 else 0
+
+def weighted(rand, choices):
+    total = sum([w for c, w in choices])
+    x = rand.uniform(0, total)
+    for c, w in choices:
+	x -= w
+	if x <= 0:
+	    return c
+    return choices[-1][0]
+
+def cacheCode(i):
+    """
+    Make a GC code out of a number, spreading the codes around so that
+    they are not in insertion order.
+    """
+    digits = '0123456789ABCDEFGHJKMNPQRTVWXYZ'
+    n = (i * 7919 + 12345) % (31 ** 5)
+    s = ''
+    for j in range(5):
+	s = digits[n % 31] + s
+	n //= 31
+    return 'GC' + s
+
+def date(rand, startyear, endyear):
+    return '%04d-%02d-%02d' % (rand.randint(startyear, endyear),
+	    rand.randint(1, 12), rand.randint(1, 28))
+
+def coord(x):
+    return '%.6f' % x
+
+CreateTables = """
+create table caches (Code text primary key, Name text, PlacedBy text,
+    OwnerName text, OwnerId text, SmartName text, CacheType text,
+    Container text, Difficulty real, Terrain real, Latitude text,
+    Longitude text, PlacedDate text, LastFoundDate text, LastGPXDate text,
+    LastLog text, Archived integer, TempDisabled integer,
+    HasTravelBug integer, Found integer, FoundByMeDate text, DNF integer,
+    Watch integer, Lock integer, Country text, State text, County text,
+    Elevation real, FavPoints integer, NumberOfLogs integer, Url text,
+    UserData text, User2 text, User3 text, User4 text, Guid text,
+    Status text, Changed text);
+create table cachememo (Code text primary key, LongDescription text,
+    ShortDescription text, Hints text, TravelBugs text, UserNote text,
+    Url text);
+create table logs (lParent text, lLogId integer, lType text, lBy text,
+    lDate text, lLat text, lLon text, lTime text, lOwnerId text,
+    lIsowner integer, lEncoded integer);
+create table logmemo (lParent text, lLogId integer primary key,
+    lText text);
+create table attributes (aCode text, aId integer, aInc integer);
+create table waypoints (cParent text, cCode text, cName text, cType text,
+    cLat text, cLon text, cByUser integer, cDate text, cFlag integer);
+create table waymemo (cParent text, cCode text, cComment text, cUrl text,
+    primary key (cParent, cCode));
+create index LogsParent on logs (lParent);
+create index AttributesCode on attributes (aCode);
+create index WaypointsParent on waypoints (cParent);
+"""
+
+def generate(fname, caches=1000, logs=20, desclen=2000, html=0.15,
+	uni=0.02, waypoints=0.5, center=(39.0, -77.0), spread=1.0, seed=1):
+    """
+    Write a GSAK database with the given number of caches to fname.
+    logs is the mean number of logs per cache, desclen the mean length of
+    a long description and waypoints the mean number of additional
+    waypoints per cache. Caches are placed within spread degrees of
+    center.
+    """
+    rand = random.Random(seed)
+    maker = TextMaker(rand, html, uni)
+    if os.path.exists(fname):
+	os.remove(fname)
+    conn = sqlite3.connect(fname)
+    conn.executescript(CreateTables)
+
+    owners = [maker.text(8).replace('\n', ' ') for i in range(200)]
+    cachers = [maker.text(10).replace('\n', ' ') for i in range(2000)]
+    logid = 1
+    for i in range(caches):
+	code = cacheCode(i)
+	lat = center[0] + rand.uniform(-spread, spread)
+	lon = center[1] + rand.uniform(-spread, spread)
+	cachetype = weighted(rand, CacheTypeWeights)
+	owner = rand.choice(owners)
+	hastb = rand.random() < 0.2
+	nlogs = int(rand.expovariate(1.0 / logs)) if logs > 0 else 0
+	placed = date(rand, 2001, 2016)
+	name = maker.text(rand.randint(8, 40)).replace('\n', ' ')
+	conn.execute('insert into caches values (%s)' % ','.join('?' * 38), (
+	    code, name, owner, owner, str(rand.randint(1, 10 ** 7)),
+	    'S%s' % code[-4:], cachetype, rand.choice(Containers),
+	    rand.choice([1, 1.5, 2, 2.5, 3, 3.5, 4, 4.5, 5]),
+	    rand.choice([1, 1.5, 2, 2.5, 3, 3.5, 4, 4.5, 5]),
+	    coord(lat), coord(lon), placed,
+	    date(rand, 2014, 2016) if nlogs else '', date(rand, 2016, 2016),
+	    '', rand.random() < 0.02, rand.random() < 0.05, hastb,
+	    0, '', 0, 0, 0, 'United States', 'Maryland', 'Howard',
+	    rand.uniform(0, 500), rand.randint(0, 100), nlogs,
+	    'http://coord.info/%s' % code, '', '', '', '',
+	    '%08x-0000-0000-0000-%012x' % (i, i), 'A', placed))
+
+	conn.execute('insert into cachememo values (?,?,?,?,?,?,?)', (
+	    code,
+	    maker.text(maker.size(desclen)),
+	    maker.text(maker.size(desclen / 10)),
+	    maker.text(rand.randint(0, 80)),
+	    maker.text(rand.randint(10, 100)) if hastb else '',
+	    '', 'http://coord.info/%s' % code))
+
+	for j in range(nlogs):
+	    haspos = rand.random() < 0.05
+	    conn.execute('insert into logs values (?,?,?,?,?,?,?,?,?,?,?)', (
+		code, logid, weighted(rand, LogTypes), rand.choice(cachers),
+		date(rand, 2002, 2016),
+		coord(lat + rand.uniform(-0.001, 0.001)) if haspos else '',
+		coord(lon + rand.uniform(-0.001, 0.001)) if haspos else '',
+		'', str(rand.randint(1, 10 ** 7)), 0, 0))
+	    conn.execute('insert into logmemo values (?,?,?)', (
+		code, logid, maker.text(maker.size(200))))
+	    logid += 1
+
+	for aid in rand.sample(sorted(AttributeNames), rand.randint(0, 8)):
+	    conn.execute('insert into attributes values (?,?,?)',
+		    (code, aid, rand.random() < 0.8))
+
+	nwpts = int(rand.expovariate(1.0 / waypoints)) if waypoints > 0 else 0
+	for j in range(nwpts):
+	    conn.execute('insert into waypoints values (?,?,?,?,?,?,?,?,?)', (
+		code, '%02d%s' % (j % 100, code[2:]),
+		maker.text(rand.randint(5, 30)).replace('\n', ' '),
+		rand.choice(WaypointTypes),
+		coord(lat + rand.uniform(-0.01, 0.01)),
+		coord(lon + rand.uniform(-0.01, 0.01)),
+		0, placed, 0))
+	    conn.execute('insert into waymemo values (?,?,?,?)', (
+		code, '%02d%s' % (j % 100, code[2:]),
+		maker.text(rand.randint(0, 200)), ''))
+
+    conn.commit()
+    conn.close()
+
+def writeStatic(fname):
+    """
+    Write a GSAK static database with the lookup table for the generated
+    cache types and attributes.
+    """
+    if os.path.exists(fname):
+	os.remove(fname)
+    conn = sqlite3.connect(fname)
+    conn.execute('create table lookup (type text, vfrom text, vto text)')
+    conn.executemany('insert into lookup values (?,?,?)',
+	    [('CacheTypes', k, CacheTypeNames[k])
+		for k in sorted(CacheTypeNames)] +
+	    [('attributes', str(k), AttributeNames[k])
+		for k in sorted(AttributeNames)])
+    conn.commit()
+    conn.close()
+
+def main():
+    parser = OptionParser(usage = 'usage: %prog [options] [dbfile]')
+    parser.add_option('-n', '--caches', dest='caches', type='int',
+	    default=1000, help='Number of caches. Default: %default.')
+    parser.add_option('-l', '--logs', dest='logs', type='float', default=20,
+	    help='Mean number of logs per cache. Default: %default.')
+    parser.add_option('-d', '--desc-length', dest='desclen', type='int',
+	    default=2000,
+	    help='Mean length of a long description. Default: %default.')
+    parser.add_option('-m', '--html', dest='html', type='float',
+	    default=0.15,
+	    help='Fraction of text that is HTML markup. Default: %default.')
+    parser.add_option('-u', '--unicode', dest='uni', type='float',
+	    default=0.02,
+	    help='Fraction of words with non-ASCII characters. '
+	    'Default: %default.')
+    parser.add_option('-w', '--waypoints', dest='waypoints', type='float',
+	    default=0.5,
+	    help='Mean number of additional waypoints per cache. '
+	    'Default: %default.')
+    parser.add_option('-s', '--seed', dest='seed', type='int', default=1,
+	    help='Random seed. Default: %default.')
+    parser.add_option('-t', '--static', dest='static',
+	    help='Also write a matching static.db3 to this file.')
+
+    (options, args) = parser.parse_args()
+
+    if len(args) > 1 or not args and not options.static:
+	parser.print_help()
+	sys.exit(1)
+
+    if options.static:
+	staticdir = os.path.dirname(options.static)
+	if staticdir and not os.path.isdir(staticdir):
+	    os.makedirs(staticdir)
+	writeStatic(options.static)
+
+    if args:
+	dbdir = os.path.dirname(args[0])
+	if dbdir and not os.path.isdir(dbdir):
+	    os.makedirs(dbdir)
+	generate(args[0], options.caches, options.logs, options.desclen,
+		options.html, options.uni, options.waypoints, seed=options.seed)
+
+
+if __name__ == '__main__':
+    main()
+
+# vim:set tw=0:
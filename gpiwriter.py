@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+"""
+gpiwriter.py - Garmin GPI files, the format POI Loader turns GPX files into.
+
+A GPI file is a list of records. Each record starts with a 16-bit type, 16
+bits of flags and the length of its data. With flag 8, the record has
+records of its own after its data, and the length of its data alone comes
+after the total length. All numbers are little-endian.
+
+The file written here has a header, then one group of points named after
+the file, as POI Loader names its categories. The group holds the points in
+a tree of areas, with no more than MaxAreaPoints in each, and the bitmap
+that every point is shown with.
+"""
+
+import re
+import struct
+
+# Record types.
+HeaderRecord = 0
+PoiHeaderRecord = 1
+PointRecord = 2
+BitmapRefRecord = 4
+BitmapRecord = 5
+AreaRecord = 8
+GroupRecord = 9
+CommentRecord = 10
+EndRecord = 0xffff
+
+# Records with this flag hold other records.
+HasRecords = 8
+
+# Creation time in the header, in seconds since the Garmin epoch,
+# 1989-12-31. This is 2008-05-01, the date in the GPX files, so that the
+# output doesn't change from run to run.
+CreateTime = 1209600000 - 631065600
+
+CodePage = 1252
+
+# Split areas with more points than this into quarters.
+MaxAreaPoints = 128
+
+# Never split an area more often than this, in case there are more points
+# at one spot than fit in an area.
+MaxAreaDepth = 16
+
+# Color of the bitmap that is shown as transparent.
+TransparentColor = 0xff00ff
+
+def semicircles(deg):
+    """
+    Convert degrees to the 32-bit units Garmin uses for coordinates.
+    """
+    return max(-0x80000000, min(0x7fffffff, int(deg * 2147483648.0 / 180.0)))
+
+def record(rtype, data, records=None):
+    """
+    Build a record, with other records inside it if records is not None.
+    """
+    if records is None:
+	return struct.pack('<HHI', rtype, 0, len(data)) + data
+    return struct.pack('<HHII', rtype, HasRecords, len(data) + len(records),
+	    len(data)) + data + records
+
+def shortString(s):
+    return struct.pack('<H', len(s)) + s
+
+def string(s):
+    """
+    Build a string in the form used for names and comments, tagged with a
+    language.
+    """
+    s = 'EN' + shortString(s)
+    return struct.pack('<I', len(s)) + s
+
+CharRefRe = re.compile(r'&#(?:(\d+)|[xX]([0-9a-fA-F]+));')
+
+def charRefRepl(matchobj):
+    try:
+	if matchobj.group(1) is not None:
+	    c = unichr(int(matchobj.group(1)))
+	else:
+	    c = unichr(int(matchobj.group(2), 16))
+    except (ValueError, OverflowError):
+	return '?'
+    return c.encode('cp1252', 'replace')
+
+def text(s):
+    """
+    Get the text that POI Loader would read from s if it were in a GPX
+    file, in the code page of the GPI file. &amp; goes last, so that
+    escaped entity refs stay as they are.
+    """
+    if isinstance(s, unicode):
+	s = s.encode('cp1252', 'replace')
+    s = s.replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"')
+    s = s.replace('&apos;', "'")
+    if '&#' in s:
+	s = CharRefRe.sub(charRefRepl, s)
+    return s.replace('&amp;', '&')
+
+def header(name):
+    """
+    Build the records that start a GPI file.
+    """
+    return record(HeaderRecord, 'GRMREC00' +
+	    struct.pack('<IH', CreateTime, 0) + shortString(name)) + \
+	    record(PoiHeaderRecord, 'POI\0\0\0' + '01' +
+		    struct.pack('<HH', CodePage, 0))
+
+def point(lat, lon, name, comment, bitmap=0):
+    """
+    Build the record of a point, shown with the bitmap of that index. name
+    and comment are as they would be written to a GPX file.
+    """
+    data = struct.pack('<iiHB', semicircles(lat), semicircles(lon), 1, 0) + \
+	    string(text(name))
+    records = record(BitmapRefRecord, struct.pack('<H', bitmap))
+    comment = text(comment)
+    if comment:
+	records += record(CommentRecord, string(comment))
+    return record(PointRecord, data, records)
+
+def pointPosition(rec):
+    """
+    Get the coordinates of a point record from point, in semicircles.
+    """
+    return struct.unpack('<ii', rec[12:20])
+
+def bitmap(bmp, index=0):
+    """
+    Build a bitmap record from the contents of an uncompressed 24- or
+    32-bit BMP file.
+    """
+    offset, = struct.unpack('<I', bmp[10:14])
+    width, height, planes, bpp, compression = struct.unpack('<iiHHI',
+	    bmp[18:34])
+    if bpp not in (24, 32) or compression != 0:
+	raise ValueError('only uncompressed 24- and 32-bit bitmaps are '
+		'supported')
+    linesize = (width * bpp + 31) // 32 * 4
+    lines = [bmp[offset + i * linesize:offset + (i + 1) * linesize]
+	    for i in range(abs(height))]
+    if height > 0:
+	# BMP files are stored bottom-up, GPI bitmaps top-down.
+	lines.reverse()
+    pixels = ''.join(lines)
+    # The pixels start 0x2c bytes into the record, right after this.
+    return record(BitmapRecord, struct.pack('<HHHHHHIIIIII', index,
+	abs(height), width, linesize, bpp, 0, len(pixels), 0x2c, 0,
+	TransparentColor, 1, len(pixels) + 0x2c) + pixels)
+
+def area(points, depth=0):
+    """
+    Build the area records for points, given as (lat, lon, offset, length)
+    as for write. Returns the area records as strings, with the points
+    where their records go, to save joining them up, and the total length.
+    """
+    lats = [p[0] for p in points]
+    lons = [p[1] for p in points]
+    north, south, east, west = max(lats), min(lats), max(lons), min(lons)
+    data = struct.pack('<iiiiIHB', north, east, south, west, 0, 1, 0)
+
+    parts = []
+    size = 0
+    if len(points) <= MaxAreaPoints or depth >= MaxAreaDepth or \
+	    (north == south and east == west):
+	for p in points:
+	    parts.append(p)
+	    size += p[3]
+    else:
+	midlat = (north + south) // 2
+	midlon = (east + west) // 2
+	quarters = [[], [], [], []]
+	for p in points:
+	    quarters[(p[0] > midlat) * 2 + (p[1] > midlon)].append(p)
+	for quarter in quarters:
+	    if quarter:
+		subparts, subsize = area(quarter, depth + 1)
+		parts.extend(subparts)
+		size += subsize
+
+    head = struct.pack('<HHII', AreaRecord, HasRecords, len(data) + size,
+	    len(data)) + data
+    return [head] + parts, len(head) + size
+
+def write(f, name, category, points, spool, bmp):
+    """
+    Write a GPI file to f, which only needs a write method. points are
+    records from point, all shown with the bitmap from bitmap. They are
+    read from the file spool, and given as (lat, lon, offset, length): the
+    position from pointPosition and where the record is in spool. That
+    way, only the records of one area at a time need to be in memory.
+    """
+    parts = []
+    size = 0
+    if points:
+	parts, size = area(points)
+    data = string(text(category))
+    f.write(header(name))
+    f.write(struct.pack('<HHII', GroupRecord, HasRecords,
+	len(data) + size + len(bmp), len(data)) + data)
+    for part in parts:
+	if isinstance(part, str):
+	    f.write(part)
+	else:
+	    spool.seek(part[2])
+	    f.write(spool.read(part[3]))
+    f.write(bmp)
+    f.write(record(EndRecord, ''))
+
+# vim:set tw=0:
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+gpxwriter.py - Buffered output file that only appears once it is complete.
+
+The output is written to a temporary file next to the real one, which is
+renamed over it when the file is closed. If nuvigc dies halfway, the
+previous GPX file is left as it was instead of a truncated one that POI
+Loader cannot read.
+"""
+
+import os
+import gzip
+import time
+import fileutil
+
+# Write to the file in pieces of about this many bytes.
+WriteBatch = 256 * 1024
+
+class GPXWriter:
+    """
+    Collect output and write it in large pieces. If compress is true, the
+    output is gzipped. If binary is true, line ends are left alone on
+    Windows.
+    """
+    def __init__(self, fname, compress=False, binary=False):
+	self.fname = fname
+	self.tmpname = fname + '.tmp'
+	if compress:
+	    self.f = gzip.GzipFile(self.tmpname, 'wb')
+	elif binary:
+	    self.f = open(self.tmpname, 'wb', WriteBatch)
+	else:
+	    # Text mode, as before, so that lines end in CRLF on Windows.
+	    self.f = open(self.tmpname, 'w', WriteBatch)
+	self.parts = []
+	self.buffered = 0
+	self.bytes = 0
+	self.iotime = 0.0
+	self.start = time.time()
+
+    def write(self, s):
+	self.parts.append(s)
+	self.buffered += len(s)
+	if self.buffered >= WriteBatch:
+	    self.flush()
+
+    def flush(self):
+	data = ''.join(self.parts)
+	self.parts = []
+	self.buffered = 0
+	start = time.time()
+	self.f.write(data)
+	self.iotime += time.time() - start
+	self.bytes += len(data)
+
+    def close(self):
+	"""
+	Finish writing and put the file in place.
+	"""
+	self.flush()
+	start = time.time()
+	self.f.close()
+	self.iotime += time.time() - start
+	fileutil.replaceFile(self.tmpname, self.fname)
+
+    def abort(self):
+	"""
+	Throw away the output, leaving any previous file alone.
+	"""
+	self.f.close()
+	if os.path.exists(self.tmpname):
+	    os.remove(self.tmpname)
+
+    def stats(self):
+	"""
+	Describe how much was written and how fast.
+	"""
+	return stats([self])
+
+def stats(writers):
+    """
+    Describe how much was written to a set of files and how fast.
+    """
+    if not writers:
+	return 'Wrote nothing'
+    elapsed = time.time() - min([w.start for w in writers])
+    mb = sum([w.bytes for w in writers]) / 1048576.0
+    iotime = sum([w.iotime for w in writers])
+    return 'Wrote %.1f MB in %.1f s, %.1f MB/s; %.1f s of that writing ' \
+	    'to disk at %.1f MB/s' % (
+	    mb, elapsed, mb / max(elapsed, 1e-6),
+	    iotime, mb / max(iotime, 1e-6))
+
+# vim:set tw=0:
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""
+gsakdb.py - Find and open GSAK databases.
+
+nuvigc only ever reads GSAK's databases, often while GSAK has them open
+too, so they are opened read-only. A database can also be opened as
+immutable, which skips SQLite's file locking altogether. That is safe only
+if nothing changes the database while it is being read.
+
+SQLite can be tuned with a pragma profile. Each connection gets its own
+settings, so every process that reads the database should open its own.
+"""
+
+import sys
+import os
+import os.path
+import sqlite3
+import urllib
+import binascii
+
+# Pragmas for each profile. A negative cache_size is in KB rather than
+# pages. mmap_size lets SQLite read the file through memory mapping instead
+# of read calls.
+Profiles = {
+    'default': [
+	('cache_size', 20000),
+	],
+    'small': [
+	('cache_size', -8192),
+	('mmap_size', 0),
+	('temp_store', 'file'),
+	],
+    'mmap': [
+	('cache_size', 20000),
+	('mmap_size', 1 << 30),
+	('temp_store', 'memory'),
+	],
+    'large': [
+	('cache_size', -262144),
+	('mmap_size', 1 << 30),
+	('temp_store', 'memory'),
+	],
+}
+
+useURI = None
+
+def appDataPath():
+    """
+    Try to get the Windows application data path by various means.
+    """
+    s = os.environ.get('APPDATA')
+    if s is not None:
+	return s
+
+    userprof = os.environ.get('USERPROFILE')
+    if userprof is not None:
+	return userprof + '/Application Data'
+
+    homedrive = os.environ.get('HOMEDRIVE')
+    homepath = os.environ.get('HOMEPATH')
+
+    if homedrive is not None and homepath is not None:
+	return '%s%s/Application Data' % (homedrive, homepath)
+
+    if homedrive is None:
+	homedrive = 'C:'
+
+    username = os.environ.get('USERNAME')
+    if username is not None:
+	return '%s/Documents and Settings/%s/Application Data'
+
+    return ''
+
+def progfilePath():
+    """
+    Try to get the Program Files path.
+    """
+
+    # On 64-bit systems, GSAK gets installed here instead.
+    s = os.environ.get('ProgramFiles(x86)')
+    if s is not None:
+	return s
+
+    s = os.environ.get('ProgramFiles')
+    if s is not None:
+	return s
+
+    homedrive = os.environ.get('HOMEDRIVE')
+    if homedrive is None:
+	homedrive = 'C:'
+
+    return '%s/Program Files' % homedrive
+
+def dbPath(gsakdir, dbname):
+    """
+    Get the file name of a GSAK database.
+    """
+    return '%s/%s/data/%s/sqlite.db3' % (appDataPath(), gsakdir, dbname)
+
+def staticPath(gsakdir):
+    """
+    Get the file name of GSAK's static database.
+    """
+    return '%s/%s/static.db3' % (progfilePath(), gsakdir)
+
+def uriSupported():
+    """
+    Check whether SQLite takes file: URIs as database names. Python 2's
+    sqlite3 module cannot turn them on, so it depends on how SQLite was
+    built.
+    """
+    global useURI
+    if useURI is None:
+	conn = sqlite3.connect(':memory:')
+	options = [row[0] for row in conn.execute('pragma compile_options')]
+	conn.close()
+	useURI = 'USE_URI' in options or 'USE_URI=1' in options
+    return useURI
+
+def fileStates(dbfile):
+    """
+    Get the state of a database file and of its -wal file, which changes
+    whenever anything commits to the database: the inode, size and
+    modification time of each, along with the change counter in the header
+    of the database and the checkpoint count and salts in the header of
+    the -wal file. Those change on every commit, even if the time and size
+    of the files do not. Each file that does not exist has a state of
+    None.
+    """
+    states = []
+    for fname, offset, size in ((dbfile, 24, 4), (dbfile + '-wal', 12, 12)):
+	try:
+	    st = os.stat(fname)
+	    f = open(fname, 'rb')
+	    try:
+		f.seek(offset)
+		header = binascii.hexlify(f.read(size))
+	    finally:
+		f.close()
+	    states.append((st.st_ino, st.st_size, st.st_mtime, header))
+	except (IOError, OSError):
+	    states.append(None)
+    return states
+
+def connect(fname, profile='default', immutable=False, anyThread=False):
+    """
+    Open a database read-only and apply a pragma profile. If anyThread is
+    true, the connection can be used by threads other than the one that
+    opened it, though only by one at a time.
+    """
+    if not os.path.exists(fname):
+	# Don't let SQLite create an empty database.
+	raise sqlite3.OperationalError('unable to open database file')
+
+    if uriSupported():
+	uri = 'file:%s?mode=ro' % urllib.pathname2url(os.path.abspath(fname))
+	if immutable:
+	    uri += '&immutable=1'
+	conn = sqlite3.connect(uri, check_same_thread=not anyThread)
+    else:
+	if immutable:
+	    print >> sys.stderr, 'SQLite does not support immutable mode ' \
+		    'here. Opening %s read-only.' % fname
+	conn = sqlite3.connect(fname, check_same_thread=not anyThread)
+	conn.execute('PRAGMA query_only=1')
+
+    conn.row_factory = sqlite3.Row
+    for name, value in Profiles[profile]:
+	conn.execute('PRAGMA %s=%s' % (name, value))
+    return conn
+
+# vim:set tw=0:
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""
+lookupcache.py - Cache types and attributes from GSAK's static database.
+
+GSAK keeps the names of cache types and attributes in the lookup table of
+static.db3, which can change when GSAK is updated. They are read from
+there and saved, ready to use, in lookup.json next to this script. The
+saved copy is read again whenever static.db3 changes. The text that
+nuvigc shows for each attribute is worked out in advance, so that
+formatting attributes is just a table lookup.
+"""
+
+import os
+import os.path
+import json
+import gsakdb
+import fileutil
+
+# Change this whenever the contents of the cache file change.
+CacheVersion = '1'
+
+CacheFile = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+	'lookup.json')
+
+# Text for attributes that static.db3 does not know about.
+UnknownAttribute = (u'Unknown attr=N', u'Unknown attr=Y')
+
+def stamp(fname):
+    st = os.stat(fname)
+    return '%d/%d' % (st.st_size, int(st.st_mtime))
+
+def attributeText(name):
+    """
+    Get the text for an attribute that is off and on.
+    """
+    return (u'%s=N' % name, u'%s=Y' % name)
+
+def build(fname):
+    """
+    Read the lookup tables from static.db3.
+    """
+    conn = gsakdb.connect(fname)
+    curs = conn.cursor()
+    curs.execute("select * from lookup where type = 'CacheTypes'")
+    cachetypes = dict([(row['vfrom'], row['vto'][0:3]) for row in curs])
+    curs.execute("select * from lookup where type = 'attributes'")
+    attributes = [(int(row['vfrom']), row['vto']) for row in curs]
+    conn.close()
+    return {
+	'version': CacheVersion,
+	'CacheTypes': cachetypes,
+	'Attributes': [(aid, name) + attributeText(name)
+	    for aid, name in attributes],
+	}
+
+def save(tables, cachefile):
+    """
+    Write the cache file. Not being able to is not an error, since the
+    tables can always be read from static.db3 again.
+    """
+    tmpname = '%s.%d.tmp' % (cachefile, os.getpid())
+    try:
+	f = open(tmpname, 'w')
+	json.dump(tables, f, indent=1, sort_keys=True)
+	f.close()
+	fileutil.replaceFile(tmpname, cachefile)
+    except (IOError, OSError):
+	if os.path.exists(tmpname):
+	    os.remove(tmpname)
+
+def load(gsakdir, cachefile=CacheFile):
+    """
+    Get the cache type abbreviations by code and the attribute texts by id,
+    as (text when off, text when on). Returns those and whether they had to
+    be read from static.db3. Raises sqlite3.OperationalError if static.db3
+    cannot be read and there is no saved copy of it.
+    """
+    fname = gsakdb.staticPath(gsakdir)
+    try:
+	f = open(cachefile)
+	tables = json.load(f)
+	f.close()
+    except (IOError, ValueError):
+	tables = None
+
+    try:
+	current = stamp(fname)
+    except OSError:
+	# Without static.db3, take whatever was saved from it.
+	current = None
+
+    rebuilt = False
+    if tables is None or tables.get('version') != CacheVersion or \
+	    tables.get('source') != fname or \
+	    current is not None and tables.get('stamp') != current:
+	tables = build(fname)
+	tables['source'] = fname
+	tables['stamp'] = current
+	save(tables, cachefile)
+	rebuilt = True
+
+    cachetypes = dict(tables['CacheTypes'])
+    attributes = dict([(row[0], tuple(row[2:])) for row in tables['Attributes']])
+    return cachetypes, attributes, rebuilt
+
+# vim:set tw=0:
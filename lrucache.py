@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""
+lrucache.py - A least-recently-used cache with a cap on memory use.
+"""
+
+import collections
+
+class LRUCache:
+    """
+    Keep values up to a total size of maxsize, dropping the least recently
+    used ones first. sizefunc gives the size of a value, and must give the
+    same size every time for the same value, since sizes are not stored.
+    The newest value is always kept, even if it is larger than maxsize on
+    its own.
+
+    get counts hits and misses. Indexing and the in operator do not, and
+    do not change the order in which values are dropped.
+    """
+    def __init__(self, maxsize, sizefunc=len):
+	self.maxsize = maxsize
+	self.sizefunc = sizefunc
+	self.table = collections.OrderedDict()
+	self.size = 0
+	self.hits = 0
+	self.misses = 0
+
+    def __contains__(self, key):
+	return key in self.table
+
+    def __getitem__(self, key):
+	return self.table[key]
+
+    def __len__(self):
+	return len(self.table)
+
+    def get(self, key, default=None):
+	try:
+	    item = self.table.pop(key)
+	except KeyError:
+	    self.misses += 1
+	    return default
+	self.table[key] = item
+	self.hits += 1
+	return item
+
+    def put(self, key, value):
+	if key in self.table:
+	    self.size -= self.sizefunc(self.table.pop(key))
+	self.table[key] = value
+	self.size += self.sizefunc(value)
+	while self.size > self.maxsize and len(self.table) > 1:
+	    self.size -= self.sizefunc(self.table.popitem(last=False)[1])
+
+    def clear(self):
+	self.table.clear()
+	self.size = 0
+
+# vim:set tw=0:
@@ -19,13 +19,34 @@ import sys
 import sqlite3
 import re
 import string
-from HTMLParser import HTMLParser, HTMLParseError
+from HTMLParser import HTMLParseError
 from optparse import OptionParser
 import os
 import os.path
 import nuvifiles
 import base64
-from lookup import CacheTypes, Attributes
+import itertools
+import operator
+import collections
+import multiprocessing
+import hashlib
+import zlib
+import fragcache
+import lrucache
+import records
+import gpxwriter
+import gpiwriter
+import stageprof
+import gsakdb
+import shards
+import spatial
+import json
+import time
+import Queue
+import traceback
+import threading
+import tempfile
+import lookupcache
 
 LogConv = {
 	'found it':'F',
@@ -36,6 +57,89 @@ LogConv = {
 
 TextLimit = 16500
 
+# Number of rows handed to the worker pool at a time, and how many of
+# those each worker takes in one go.
+RenderBatch = 2000
+RenderChunk = 50
+
+# Default memory cap for log texts, in MB. Log texts are read from logmemo
+# in batches, starting with LogBatch logs and doubling up to LogBatchMax.
+LogCacheSize = 32
+LogBatch = 10
+LogBatchMax = 500
+
+# Memory cap for sanitized texts kept by TextMemo, in MB. Texts shorter
+# than TextMemoMin bytes are sanitized every time, since that is about as
+# fast as looking them up.
+TextMemoSize = 16
+TextMemoMin = 128
+
+# With --pipeline, rows and waypoints are passed between threads in
+# chunks of PipeChunk, and at most PipeDepth chunks may wait to be
+# rendered or written.
+PipeChunk = 100
+PipeDepth = 4
+
+# Change this whenever the GPX generated for a cache or waypoint changes,
+# so that fragments stored by --incremental are not reused.
+FragmentVersion = '3'
+
+# Columns read from each table. Only these are fetched, rather than every
+# column of the wide GSAK tables.
+CacheColumns = ('Code', 'SmartName', 'CacheType', 'Name', 'OwnerName',
+	'Container', 'Difficulty', 'Terrain', 'Latitude', 'Longitude',
+	'PlacedDate', 'LastFoundDate', 'HasTravelBug', 'Archived',
+	'TempDisabled')
+CacheMemoColumns = ('Code', 'TravelBugs', 'LongDescription',
+	'ShortDescription', 'Hints')
+AttrColumns = ('aCode', 'aId', 'aInc')
+# The last column of the logs is a checksum of their text, from logmemo.
+LogColumns = ('lParent', 'lLogId', 'lType', 'lBy', 'lDate', 'lLat', 'lLon',
+	'lTextCrc')
+WaypointColumns = ('cParent', 'cCode', 'cType', 'cLat', 'cLon')
+
+# When several databases are processed in parallel, each worker process
+# sends its progress to the parent through this queue instead of printing
+# it, tagged with the name of the database.
+progressQueue = None
+progressName = None
+
+# The Converter of a rendering worker process. Set by init_worker.
+worker = None
+
+# Set by --profile. Number of slowest caches to report.
+profiler = None
+ProfileTop = 20
+
+
+def columns(table, cols):
+    """
+    Get the start of a query that reads cols from table.
+    """
+    return 'select %s from %s' % (', '.join(cols), table)
+
+def selected(col, filtered):
+    """
+    Get a where clause that limits a query to the caches picked by area, if
+    filtered. Those are in the selection table of the spatial index, which
+    is attached to the connection as idx. col is the column with the cache
+    code.
+    """
+    if not filtered:
+	return ''
+    return ' where %s in (select Code from idx.selection)' % col
+
+def logsQuery(filtered):
+    """
+    Get the query that reads LogColumns, newest first for each cache. The
+    checksum of each text lets fingerprints tell that a log was edited
+    without the text being read into memory.
+    """
+    return 'select %s, textcrc(cast(lText as blob)) as lTextCrc from logs ' \
+	    'left join logmemo using (lLogId)%s ' \
+	    'order by logs.lParent, lDate desc, logs.rowid' % (
+	    ', '.join(['logs.' + col for col in LogColumns[:-1]]),
+	    selected('logs.lParent', filtered))
 
 def escAmp(s):
     """
@@ -50,47 +154,51 @@ def enc(s):
     """
     return s.encode('ascii', 'xmlcharrefreplace')
 
+def dec(s):
+    """
+    Decode a text value from the database, ignoring characters that cannot
+    be decoded from utf-8. Text comes from the database undecoded, so that
+    only the values that are actually rendered pay for this. Anything
+    other than text is passed through.
+    """
+    if isinstance(s, str):
+	return unicode(s, 'utf-8', 'ignore')
+    return s
+
 class LogsTable:
     """
-    Prefetch logs table.
+    Prefetch logs table. The logs of each cache are kept packed, newest
+    first.
     """
-    def __init__(self):
+    def __init__(self, conn, filtered):
+	self.conn = conn
+	self.filtered = filtered
 	self.table = {}
 
     def queryData(self):
-	curs = conn.cursor()
-	curs.execute('select * from logs')
-	for row in curs:
-	    self.table[row['lParent']] = self.table.get(row['lParent'], []) + [row]
-	for lpar, row in self.table.iteritems():
-	    row.sort(key=lambda r: r['lDate'], reverse=True)
-
-    def getRows(self, parent):
+	curs = self.conn.cursor()
+	curs.row_factory = None
+	curs.execute(logsQuery(self.filtered))
+	key = operator.itemgetter(LogColumns.index('lParent'))
+	for parent, rows in itertools.groupby(curs, key):
+	    self.table[records.share(parent)] = records.pack(rows)
+
+    def load(self):
 	if not self.table:
 	    self.queryData()
-	return self.table.get(parent, [])
 
+    def packed(self, parent):
+	self.load()
+	return self.table.get(parent, ())
 
-def last4(code):
-    """
-    Summarize last 4 cache logs.
-    """
-#     curs = conn.cursor()
-#     curs.execute('select lType from logs where lParent=? order by lDate desc', (code, ))
-#     rows = curs.fetchall()
-#     curs.close()
-    rows = logsTable.getRows(code)
-    rowcount = len(rows)
-
-    l4 = ''
-
-    for i in range(4):
-	if i >= rowcount:
-	    l4 += '0'
-	else:
-	    l4 += LogConv.get(string.lower(rows[i]['lType']), 'X')
-
-    return l4
+    def logIds(self, parent, count=None):
+	"""
+	Get the ids of the logs of a cache, newest first, only the first
+	count if given. Unlike packed, this never reads the database, so that
+	another thread can call it once the table is loaded.
+	"""
+	return records.column(LogColumns, self.table.get(parent, ()), 'lLogId',
+		count)
 
 def convcoord(coord):
     deg = int(coord)
@@ -119,252 +227,639 @@ class CacheMemo:
     """
     Prefetch cachememo table.
     """
-    def __init__(self):
+    def __init__(self, conn, filtered):
+	self.conn = conn
+	self.filtered = filtered
 	self.table = {}
 
     def queryData(self):
-	curs = conn.cursor()
-	curs.execute('select * from cachememo')
+	curs = self.conn.cursor()
+	curs.row_factory = None
+	curs.execute(columns('cachememo', CacheMemoColumns) +
+		selected('Code', self.filtered))
+	key = CacheMemoColumns.index('Code')
 	for row in curs:
-	    self.table[row['Code']] = row
+	    self.table[records.share(row[key])] = records.pack([row])
 
-    def getRow(self, code):
+    def packed(self, code):
 	if not self.table:
 	    self.queryData()
-	return self.table[code]
+	return self.table.get(code, ())
 
-
-def travelBugs(code):
-    """
-    Get list of travel bugs.
-    """
-    return cacheMemo.getRow(code)['TravelBugs']
-#     curs = conn.cursor()
-#     curs.execute('select TravelBugs from cachememo where code=? limit 1', (code, ))
-#     row = curs.fetchone()
-#     curs.close()
-#     return row['TravelBugs']
-
-def getText(code):
-    """
-    Get textual info for cache.
-    """
-#     curs = conn.cursor()
-#     curs.execute('select LongDescription,ShortDescription,Hints from cachememo where code=? limit 1', (code, ))
-#     row = curs.fetchone()
-#     curs.close()
-    row = cacheMemo.getRow(code)
-    return (
-	    row['LongDescription'],
-	    row['ShortDescription'],
-	    row['Hints'],
-	    )
+    def getRow(self, code):
+	if not self.table:
+	    self.queryData()
+	return records.unpack(CacheMemoColumns, self.table[code])[0]
 
 class AttrTable:
     """
-    Prefetch attributes table.
+    Prefetch attributes table. The attributes of each cache are kept
+    packed.
     """
-    def __init__(self):
+    def __init__(self, conn, filtered):
+	self.conn = conn
+	self.filtered = filtered
 	self.table = {}
 
     def queryData(self):
-	curs = conn.cursor()
-	curs.execute('select * from attributes')
-	for row in curs:
-	    self.table[row['aCode']] = self.table.get(row['aCode'], []) + [row]
-
-    def getRows(self, code):
+	curs = self.conn.cursor()
+	curs.row_factory = None
+	curs.execute(columns('attributes', AttrColumns) +
+		selected('aCode', self.filtered) +
+		' order by aCode, rowid')
+	key = operator.itemgetter(AttrColumns.index('aCode'))
+	for code, rows in itertools.groupby(curs, key):
+	    self.table[records.share(code)] = records.pack(rows)
+
+    def packed(self, code):
 	if not self.table:
 	    self.queryData()
-	return self.table.get(code, [])
+	return self.table.get(code, ())
 
+    def getRows(self, code):
+	return records.unpack(AttrColumns, self.packed(code))
 
-def attribFmt(row):
-    return '%s=%s' % (
-	    Attributes.get(row['aId'], 'Unknown attr'),
-	    'Y' if row['aInc'] else 'N'
-	    )
-
-def attribs(code):
+class PackedTable:
     """
-    Get cache attributes.
+    Rows of the cachememo, attributes or logs table that were sent to a
+    worker process along with the caches they belong to, packed by cache
+    code as in the prefetch tables. This never reads the database.
     """
-    rows = attrTable.getRows(code)
-    return ', '.join([attribFmt(r) for r in rows])
-#     curs = conn.cursor()
-#     curs.execute('select * from attributes where aCode=?', (code, ))
-#     return ', '.join([attribFmt(r) for r in curs])
+    def __init__(self, cols, table):
+	self.cols = cols
+	self.table = table
+
+    def packed(self, code):
+	return self.table.get(code, ())
+
+    def getRows(self, code):
+	return records.unpack(self.cols, self.packed(code))
+
+    def getRow(self, code):
+	return records.unpack(self.cols, self.table[code])[0]
 
 class LogMemo:
     """
-    Prefetch logmemo table.
+    Read log texts from the logmemo table on demand, several logs per query,
+    and keep them in an LRU cache of at most maxsize bytes. Short texts that
+    many logs have in common are stored once, though the cache counts them
+    for each log.
     """
-    def __init__(self):
-	self.table = {}
-
-    def queryData(self):
-	curs = conn.cursor()
-	curs.execute('select * from logmemo')
-	for row in curs:
-	    self.table[row['lLogId']] = row['lText']
+    Missing = object()
+
+    def __init__(self, conn, maxsize):
+	self.conn = conn
+	self.cache = lrucache.LRUCache(maxsize, sys.getsizeof)
+
+    def fetch(self, logids):
+	"""
+	Make sure the texts of these logs are in memory. Counts a cache hit
+	or miss for each log.
+	"""
+	missing = [logid for logid in logids
+		if self.cache.get(logid, self.Missing) is self.Missing]
+	self.add(readLogTexts(self.conn, missing))
+
+    def add(self, texts):
+	"""
+	Put texts, given as (log id, text), into the cache.
+	"""
+	for logid, text in texts:
+	    self.cache.put(logid, records.share(text))
 
     def getLogText(self, logid):
-	if not self.table:
-	    self.queryData()
-	return self.table[logid]
-
-
-def logText(logid):
-    return logMemo.getLogText(logid)
-#     curs = conn.cursor()
-#     curs.execute('select lText from logmemo where lLogId=? limit 1', (logid, ))
-#     row = curs.fetchone()
-#     curs.close()
-#     return row['lText']
+	try:
+	    return self.cache[logid]
+	except KeyError:
+	    # Either not fetched or already dropped from the cache.
+	    self.fetch([logid])
+	    return self.cache[logid]
 
-def logFmt(row):
-    return """
-<font color=#0000FF>%s by %s %s</font> - %s%s%s<br><br>
-""" % (
-	row['lType'],
-	enc(escAmp(row['lBy'])),
-	row['lDate'],
-	convlat(float(row['lLat'])) + ' ' if row['lLat'] != '' else '',
-	convlon(float(row['lLon'])) + ' ' if row['lLon'] != '' else '',
-	cleanHTML(enc(escAmp(logText(row['lLogId'])))),
-	)
 
-def logs(code):
+def memoSize(entry):
     """
-    Get cache logs.
+    Get the memory taken by a TextMemo entry: the input texts and the
+    result.
     """
-#     curs = conn.cursor()
-#     curs.execute('select lType,lBy,lDate,lLat,lLon,lLogId from logs where lParent=? order by lDate desc', (code, ))
-#     return ''.join([logFmt(r) for r in curs])
-    rows = logsTable.getRows(code)
-    return ''.join([logFmt(r) for r in rows])
+    key, result = entry
+    return sum([sys.getsizeof(text) for text in key[1:]]) + \
+	    sys.getsizeof(result)
 
-def cleanStr(s):
+class TextMemo:
     """
-    HTML-escape some special characters and compress whitespace.
-    Convert some entity refs.
+    Remember the results of sanitizing text, so that text that turns up
+    again, like a description shared by a series of caches or a log posted
+    on every cache of a power trail, is only sanitized once per run.
+    Results are looked up by the name of the step and the input texts
+    themselves, undecoded, in an LRU cache of at most maxsize bytes.
+    """
+    def __init__(self, maxsize):
+	self.cache = lrucache.LRUCache(maxsize, memoSize)
+
+    def apply(self, func, *texts):
+	"""
+	Get func(*texts), which must depend on the texts alone. Counts a
+	hit or miss, unless the texts are too short to keep.
+	"""
+	if sum([len(text) for text in texts]) < TextMemoMin:
+	    return func(*texts)
+	key = (func.__name__, ) + texts
+	entry = self.cache.get(key)
+	if entry is None:
+	    entry = (key, func(*texts))
+	    self.cache.put(key, entry)
+	return entry[1]
+
+
+def readLogTexts(db, logids):
     """
-    s = re.sub(r'\s+', ' ', s)
-    s = re.sub(r'"', '&quot;', s)
-    s = re.sub(r'<', '&lt;', s)
-    s = re.sub(r'>', '&gt;', s)
+    Read the texts of logs, LogBatchMax logs per query. Yields (log id,
+    text).
+    """
+    curs = db.cursor()
+    for i in range(0, len(logids), LogBatchMax):
+	ids = logids[i:i + LogBatchMax]
+	curs.execute('select lLogId, lText from logmemo where lLogId in '
+		'(%s)' % ','.join('?' * len(ids)), ids)
+	for row in curs:
+	    yield row[0], row[1]
+    curs.close()
 
-    s = re.sub(r'&ndash;', '-', s)
-    s = re.sub(r'&mdash;', '-', s)
-    s = re.sub(r'&nbsp;', ' ', s)
-    s = re.sub(r'&ldquo;', '&quot;', s)
-    s = re.sub(r'&rdquo;', '&quot;', s)
-    s = re.sub(r'&lsquo;', "'", s)
-    s = re.sub(r'&rsquo;', "'", s)
-    s = re.sub(r'&trade;', '(TM)', s)
 
-    s = re.sub(r'&(\w+);', entity_repl, s)
+class GroupCursor:
+    """
+    Stream a query sorted by a key column, one group of rows at a time.
+    Groups must be requested in ascending key order. This lets us
+    merge-join tables sorted on cache code without prefetching them.
+    """
+    def __init__(self, conn, sql, keycol):
+	self.conn = conn
+	self.sql = sql
+	self.keycol = keycol
+	self.rows = None
+	self.pending = None
+	self.key = None
+	self.group = []
+	self.values = None
+
+    def getRows(self, key):
+	if self.rows is None:
+	    curs = self.conn.cursor()
+	    curs.execute(self.sql)
+	    self.rows = iter(curs)
+	    self.pending = next(self.rows, None)
+	if key == self.key:
+	    return self.group
+	row = self.pending
+	while row is not None and row[self.keycol] < key:
+	    row = next(self.rows, None)
+	group = []
+	while row is not None and row[self.keycol] == key:
+	    group.append(row)
+	    row = next(self.rows, None)
+	self.pending = row
+	self.key = key
+	self.group = group
+	self.values = None
+	return group
+
+    def packed(self, key):
+	self.getRows(key)
+	if self.values is None:
+	    self.values = records.pack(self.group)
+	return self.values
+
+class StreamLogsTable(GroupCursor):
+    """
+    Stream logs table.
+    """
+    def __init__(self, conn, filtered):
+	GroupCursor.__init__(self, conn, logsQuery(filtered), 'lParent')
 
-    s = re.sub(r'&#8216;', "'", s)
-    s = re.sub(r'&#8217;', "'", s)
-    s = re.sub(r'&#8220;', '&quot;', s)
-    s = re.sub(r'&#8221;', '&quot;', s)
-    s = re.sub(r'&#8211;', '-', s)
-    s = re.sub(r'&#8212;', '-', s)
+class StreamCacheMemo(GroupCursor):
+    """
+    Stream cachememo table.
+    """
+    def __init__(self, conn, filtered):
+	GroupCursor.__init__(self, conn,
+		columns('cachememo', CacheMemoColumns) +
+		selected('Code', filtered) + ' order by Code, rowid', 'Code')
 
-    s = re.sub(r'\x00', '', s)
+    def getRow(self, code):
+	rows = self.getRows(code)
+	if not rows:
+	    raise KeyError(code)
+	return rows[-1]
+
+    def packed(self, code):
+	return records.pack(self.getRows(code)[-1:])
+
+# Substitutions made by cleanStr. Entity refs not listed here are handled
+# by entity_repl and entity_num_repl. Anything else matched by CleanRe is
+# whitespace to be collapsed.
+CleanChars = {
+    '"':'&quot;',
+    '<':'&lt;',
+    '>':'&gt;',
+    '\x00':'',
+}
 
-    s = re.sub(r'&#(\d+);', entity_num_repl, s)
+CleanEntities = {
+    'ndash':'-',
+    'mdash':'-',
+    'nbsp':' ',
+    'ldquo':'&quot;',
+    'rdquo':'&quot;',
+    'lsquo':"'",
+    'rsquo':"'",
+    'trade':'(TM)',
+}
 
-    return s
+CleanNumEntities = {
+    '8216':"'",
+    '8217':"'",
+    '8220':'&quot;',
+    '8221':'&quot;',
+    '8211':'-',
+    '8212':'-',
+}
 
-def entity_repl(matchobj):
+# Everything cleanStr changes, matched in a single scan. Every alternative
+# starts with a literal character so that the regex engine can skip quickly
+# over plain text. A lone space is left alone. The entity refs that
+# cleanStr leaves unchanged are skipped so we don't call cleanRepl on them.
+CleanRe = re.compile(r''' \s+|\t\s*|\n\s*|\r\s*|\f\s*|\v\s*|"|<|>|\x00|'''
+	r'&(?!(?:quot|lt|gt|amp);)(?:#(\d+)|(\w+));')
+NumEntityRe = re.compile(r'&#(\d+);')
+
+# A place where text can be cut off without changing what CleanRe matches
+# on either side of it: no whitespace run or entity ref goes across it. So
+# cleanStr gives the same for the whole text as for the two parts.
+DescriptionCutRe = re.compile(r'[^\w#&\x00]\S')
+
+def cleanRepl(matchobj):
+    name = matchobj.group(2)
+    if name is not None:
+	s = CleanEntities.get(name)
+	return s if s is not None else entity_repl(name)
     name = matchobj.group(1)
+    if name is not None:
+	s = CleanNumEntities.get(name)
+	return s if s is not None else entity_num_repl(name)
+    return CleanChars.get(matchobj.group(0), ' ')
+
+def cleanStr(s):
+    """
+    HTML-escape some special characters and compress whitespace.
+    Convert some entity refs.
+    """
+    t = CleanRe.sub(cleanRepl, s)
+    if '\x00' in s:
+	# Stripping NULs can join up a numeric entity ref that wasn't there
+	# before. Those don't get the special cases above.
+	t = NumEntityRe.sub(lambda m: entity_num_repl(m.group(1)), t)
+    return t
+
+def entity_repl(name):
     if name == 'quot' or name == 'lt' or name == 'gt' or name == 'amp':
 	return '&%s;' % name
     else:
 	return '(%s)' % name
 
-def entity_num_repl(matchobj):
-    name = matchobj.group(1)
+def entity_num_repl(name):
     # Mac version of POI Loader doesn't handle numeric entities very well.
     return ('(#%s)' if sys.platform == 'darwin' else '&#%s;') % name
 
-class StripHTML(HTMLParser):
+# Regexes for stripHTML. These are the ones HTMLParser and markupbase use,
+# so that we split up HTML exactly the way HTMLParser does.
+CdataEndRe = {
+    'script':re.compile(r'</\s*script\s*>', re.I),
+    'style':re.compile(r'</\s*style\s*>', re.I),
+}
+IncompleteRe = re.compile('&[a-zA-Z#]')
+EntityRefRe = re.compile('&([a-zA-Z][-.a-zA-Z0-9]*)[^a-zA-Z0-9]')
+CharRefRe = re.compile('&#(?:[0-9]+|[xX][0-9a-fA-F]+)[^0-9a-fA-F]')
+StartTagOpenRe = re.compile('<[a-zA-Z]')
+CommentCloseRe = re.compile(r'--\s*>')
+TagFindRe = re.compile('([a-zA-Z][^\t\n\r\f />\x00]*)(?:\s|/(?!>))*')
+AttrFindRe = re.compile(
+    r'((?<=[\'"\s/])[^\s/>][^\s/=>]*)(\s*=+\s*'
+    r'(\'[^\']*\'|"[^"]*"|(?![\'"])[^>\s]*))?(?:\s|/(?!>))*')
+LocateStartTagEndRe = re.compile(r"""
+  <[a-zA-Z][^\t\n\r\f />\x00]*       # tag name
+  (?:[\s/]*                          # optional whitespace before attribute name
+    (?:(?<=['"\s/])[^\s/>][^\s/=>]*  # attribute name
+      (?:\s*=+\s*                    # value indicator
+	(?:'[^']*'                   # LITA-enclosed value
+	  |"[^"]*"                   # LIT-enclosed value
+	  |(?!['"])[^>\s]*           # bare value
+	 )
+       )?(?:\s|/(?!>))*
+     )*
+   )?
+  \s*                                # trailing whitespace
+""", re.VERBOSE)
+EndTagFindRe = re.compile('</\s*([a-zA-Z][-.a-zA-Z0-9:_]*)\s*>')
+DeclNameRe = re.compile(r'[a-zA-Z][-_.a-zA-Z0-9]*\s*')
+MarkedSectionCloseRe = re.compile(r']\s*]\s*>')
+MsMarkedSectionCloseRe = re.compile(r']\s*>')
+
+# Finds the next '<' or '&' like HTMLParser does, but also matches the most
+# common simple tags and entity refs so that stripHTML can deal with them
+# right away: start tag, end tag, charref and entity ref.
+TokenRe = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)(\s*/)?>|</([a-zA-Z][a-zA-Z0-9]*)>|'
+	r'&#([0-9]+);|&([a-zA-Z][-.a-zA-Z0-9]*);|<|&')
+
+# Characters after a start tag that mean the tag isn't finished yet.
+StartTagIncomplete = 'abcdefghijklmnopqrstuvwxyz=/ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+def startTagEnd(s, i):
+    """
+    Find the end of the start tag at s[i]. Returns -1 if incomplete.
+    """
+    j = LocateStartTagEndRe.match(s, i).end()
+    next = s[j:j+1]
+    if next == '>':
+	return j + 1
+    if next == '/':
+	return j + 2 if s.startswith('/>', j) else -1
+    if next == '' or next in StartTagIncomplete:
+	return -1
+    if j > i:
+	return j
+    return i + 1
+
+def markedSectionEnd(s, i):
+    """
+    Find the end of the marked section <![...]]> at s[i]. Returns -1 if
+    incomplete.
+    """
+    if i + 3 == len(s):
+	return -1
+    m = DeclNameRe.match(s, i + 3)
+    if not m:
+	raise HTMLParseError('expected name token at %r' % s[i:i+20])
+    if m.end() == len(s):
+	return -1
+    name = m.group().strip().lower()
+    if name in ('temp', 'cdata', 'ignore', 'include', 'rcdata'):
+	m = MarkedSectionCloseRe.search(s, i + 3)
+    elif name in ('if', 'else', 'endif'):
+	m = MsMarkedSectionCloseRe.search(s, i + 3)
+    else:
+	raise HTMLParseError('unknown status keyword %r in marked section' %
+		s[i+3:m.end()])
+    return m.end() if m else -1
+
+def stripHTML(s):
     """
     Strip out HTML tags except for <p> and <br>.
     Convert some HTML entities and remove the rest.
     This is for POILoader and the Nuvi, which can't handle anything
     too complicated.
+
+    This goes through the HTML the same way that HTMLParser.feed() does,
+    down to dropping an unfinished tag or entity ref at the end of the
+    input and everything after it. Raises HTMLParseError where
+    HTMLParser would.
     """
-    def __init__(self):
-	self.reset()
-	self.text = ''
-
-    def handle_data(self, d):
-	d = re.sub(r'\r', r'', d)
-	d = re.sub(r'\n', r'<br>', d)
-	self.text += d
-
-    def handle_starttag(self, tag, attrs):
-	if tag == 'p' or tag == 'br':
-	    self.text += '<%s>' % tag
-
-    def handle_startendtag(self, tag, attrs):
-	if tag == 'br':
-	    self.text += '<%s>' % tag
-
-    def handle_endtag(self, tag):
-	if tag == 'p':
-	    self.text += '</%s>' % tag
-
-    def handle_entityref(self, name):
-	if name == 'ndash' or name == 'mdash':
-	    self.text += '-'
-	elif name == 'nbsp':
-	    self.text += ' '
-	elif name == 'ldquo' or name == 'rdquo':
-	    self.text += '&quot;'
-	elif name == 'lsquo' or name == 'rsquo':
-	    self.text += "'"
-	elif name == 'trade':
-	    self.text += '(TM)'
-	elif name == 'quot' or name == 'lt' or name == 'gt' or name == 'amp':
-	    self.text += '&%s;' % name
-	else:
-	    self.text += '(%s)' % name
-
-    def handle_charref(self, name):
-	if name == '8216' or name == '8217':
-	    self.text += "'"
-	elif name == '8220' or name == '8221':
-	    self.text += '&quot;'
-	elif name == '8211' or name == '8212':
-	    self.text += '-'
-	else:
-	    # Mac version of POI Loader doesn't handle numeric entities very well.
-	    self.text += ('(#%s)' if sys.platform == 'darwin' else '&#%s;') % name
+    return ''.join(stripPieces(s))
 
-    def unknown_decl(self, decl):
-	pass
+def stripPieces(s, step=None):
+    """
+    Strip HTML like stripHTML, handing out the text in pieces: one each
+    time another step characters of the input have been read, and one at
+    the end. Text between tags is split up at those points too, so no
+    piece is much longer than step. The input is always read with all of
+    it in view, so the caller can stop at any piece and have the start of
+    what stripHTML would give.
+    """
+    out = []
+    append = out.append
+    interesting = TokenRe
+    cdata = None
+    i = 0
+    n = len(s)
+    stop = step or n
+    while i < n:
+	if i >= stop:
+	    yield ''.join(out).replace('\r', '').replace('\n', '<br>')
+	    out = []
+	    append = out.append
+	    stop = i + step
+
+	m = interesting.search(s, i)
+	if m:
+	    j = m.start()
+	else:
+	    if cdata is not None:
+		break
+	    j = n
+	while step and j > stop:
+	    append(s[i:stop])
+	    yield ''.join(out).replace('\r', '').replace('\n', '<br>')
+	    out = []
+	    append = out.append
+	    i = stop
+	    stop = i + step
+	if i < j:
+	    append(s[i:j])
+	i = j
+	if i == n:
+	    break
+
+	token = m.lastindex
+	if token is not None:
+	    if token <= 2:
+		tag = m.group(1).lower()
+		if m.group(2) is not None:
+		    if tag == 'br':
+			append('<br>')
+		else:
+		    if tag == 'p' or tag == 'br':
+			append('<%s>' % tag)
+		    if tag in CdataEndRe:
+			cdata = tag
+			interesting = CdataEndRe[tag]
+	    elif token == 3:
+		if m.group(3).lower() == 'p':
+		    append('</p>')
+	    elif token == 4:
+		name = m.group(4)
+		conv = CleanNumEntities.get(name)
+		append(conv if conv is not None else entity_num_repl(name))
+	    else:
+		name = m.group(5)
+		conv = CleanEntities.get(name)
+		append(conv if conv is not None else entity_repl(name))
+	    i = m.end()
+	    continue
+
+	if s.startswith('<', i):
+	    if StartTagOpenRe.match(s, i):
+		k = startTagEnd(s, i)
+		if k >= 0:
+		    m = TagFindRe.match(s, i + 1)
+		    tag = m.group(1).lower()
+		    j = m.end()
+		    while j < k:
+			m = AttrFindRe.match(s, j)
+			if not m:
+			    break
+			j = m.end()
+		    end = s[j:k].strip()
+		    if end not in ('>', '/>'):
+			append(s[i:k])
+		    elif end.endswith('/>'):
+			if tag == 'br':
+			    append('<br>')
+		    else:
+			if tag == 'p' or tag == 'br':
+			    append('<%s>' % tag)
+			if tag in CdataEndRe:
+			    cdata = tag
+			    interesting = CdataEndRe[tag]
+	    elif s.startswith('</', i):
+		k = s.find('>', i + 1)
+		if k >= 0:
+		    k += 1
+		    m = EndTagFindRe.match(s, i)
+		    if not m:
+			if cdata is not None:
+			    append(s[i:k])
+			else:
+			    m = TagFindRe.match(s, i + 2)
+			    if not m:
+				if not s.startswith('</>', i):
+				    # Bogus comment.
+				    k = s.find('>', i + 2) + 1
+			    else:
+				if m.group(1).lower() == 'p':
+				    append('</p>')
+				k = s.find('>', m.end()) + 1
+		    else:
+			tag = m.group(1).lower()
+			if cdata is not None and tag != cdata:
+			    append(s[i:k])
+			else:
+			    if tag == 'p':
+				append('</p>')
+			    cdata = None
+			    interesting = TokenRe
+	    elif s.startswith('<!--', i):
+		m = CommentCloseRe.search(s, i + 4)
+		k = m.end() if m else -1
+	    elif s.startswith('<?', i):
+		k = s.find('>', i + 2)
+		if k >= 0:
+		    k += 1
+	    elif s.startswith('<![', i):
+		k = markedSectionEnd(s, i)
+	    elif s.startswith('<!', i):
+		# Doctype or bogus comment.
+		k = s.find('>', i + 9 if s[i:i+9].lower() == '<!doctype' else i + 2)
+		if k >= 0:
+		    k += 1
+	    elif i + 1 < n:
+		append('<')
+		k = i + 1
+	    else:
+		break
+	    if k < 0:
+		break
+	    i = k
+
+	elif s.startswith('&#', i):
+	    m = CharRefRe.match(s, i)
+	    if not m:
+		if s.find(';', i) >= 0:
+		    append('&#')
+		break
+	    name = m.group()[2:-1]
+	    conv = CleanNumEntities.get(name)
+	    append(conv if conv is not None else entity_num_repl(name))
+	    i = m.end()
+	    if s[i-1] != ';':
+		i -= 1
 
-    def get_data(self):
-	return self.text
+	else:
+	    m = EntityRefRe.match(s, i)
+	    if m:
+		name = m.group(1)
+		conv = CleanEntities.get(name)
+		append(conv if conv is not None else entity_repl(name))
+		i = m.end()
+		if s[i-1] != ';':
+		    i -= 1
+	    elif IncompleteRe.match(s, i) or i + 1 == n:
+		break
+	    else:
+		append('&')
+		i += 1
+
+    # Tags and entity refs never produce line breaks, so we can fix up
+    # those in the text all at once.
+    yield ''.join(out).replace('\r', '').replace('\n', '<br>')
 
 def cleanHTML(s):
     """
-    Wrapper function for HTML stripper class.
+    Wrapper function for HTML stripper.
     """
-    stripper = StripHTML()
     try:
-	stripper.feed(s)
+	return stripHTML(s)
     except HTMLParseError:
 	# If the HTML parser fails, we fall back to a simple cleanup.
 	s = re.sub(r'&', r'&amp;', s)
 	s = re.sub(r'<', r'[', s)
 	s = re.sub(r'>', r']', s)
 	return s
-    return stripper.get_data()
+
+
+def cleanLogText(text):
+    return cleanHTML(enc(escAmp(dec(text))))
+
+def cleanDescription(shortdesc, longdesc):
+    """
+    Clean up the short and long descriptions of a cache. Only as much of a
+    long description is read as it takes to fill up TextLimit, since
+    processCache cuts off the rest anyway. The part that is returned then
+    comes out of cleanStr as more than TextLimit characters, so that
+    processCache always cuts it off and the output is the same as if the
+    whole description had been cleaned up.
+    """
+    s = escAmp(enc(dec(shortdesc) + '<br>' + dec(longdesc)))
+    # Marked sections can raise HTMLParseError anywhere in the text, and
+    # NULs make cleanStr look at the text as a whole, so those need all of
+    # it.
+    if '<![' in s or '\x00' in s:
+	return cleanHTML(s)
+    # The text is cut at the last DescriptionCutRe in each piece. What
+    # comes before a cut is cleaned up once, to count towards TextLimit,
+    # and the rest waits for the next piece.
+    done = []
+    size = 0
+    rest = ''
+    for piece in stripPieces(s, TextLimit):
+	start = max(0, len(rest) - 1)
+	rest += piece
+	cut = None
+	for m in DescriptionCutRe.finditer(rest, start):
+	    cut = m.start() + 1
+	if cut is None:
+	    continue
+	done.append(rest[:cut])
+	size += len(cleanStr(rest[:cut]))
+	rest = rest[cut:]
+	if size >= TextLimit + 2:
+	    return ''.join(done)
+    return ''.join(done) + rest
+
+def cleanHints(hints):
+    return cleanStr("<font color=#008000>Hint: %s</font><br>" %
+	    enc(escAmp(dec(hints))))
+
+def cleanComment(comment):
+    return cleanHTML(escAmp(dec(comment)))
 
 
 def truncate(s, length):
@@ -379,94 +874,333 @@ def truncate(s, length):
     # HTML entity behind when we truncate the string.
     return s[:-7] + re.sub(r'&', r'', s[-7:])
 
-def processCache(row):
+
+class WayMemo:
     """
-    Process a record from the caches table. Generate GPX output for that
-    geocache.
+    Prefetch waymemo table.
     """
-    wptname = '%s/%s/%s' % (row['SmartName'], CacheTypes[row['CacheType']], row['Code'])
-
-    status = ''
-    statusplain = ''
+    def __init__(self, conn, filtered):
+	self.conn = conn
+	self.filtered = filtered
+	self.table = {}
 
-    if row['TempDisabled']:
-	status = '<font color=#FF0000>*** Temp Unavailable ***</font><br><br>'
-	statusplain = '*** Temp Unavailable ***'
+    def queryData(self):
+	curs = self.conn.cursor()
+	curs.execute('select cCode, cComment from waymemo' +
+		selected('cParent', self.filtered))
+	for row in curs:
+	    self.table.setdefault(row['cCode'], records.share(row['cComment']))
 
-    if row['Archived']:
-	status = '<font color=#FF0000>*** Archived ***</font><br><br>'
-	statusplain = '*** Archived ***'
+    def getComment(self, code):
+	if not self.table:
+	    self.queryData()
+	return self.table[code]
 
-    name = escAmp(row['Name'])
-    ownername = escAmp(row['OwnerName'])
+class StreamWayMemo(GroupCursor):
+    """
+    Stream waymemo table.
+    """
+    def __init__(self, conn, filtered):
+	GroupCursor.__init__(self, conn,
+		'select cCode, cComment from waymemo' +
+		selected('cParent', filtered) + ' order by cCode, rowid',
+		'cCode')
+
+    def getComment(self, code):
+	rows = self.getRows(code)
+	if not rows:
+	    raise KeyError(code)
+	return rows[0]['cComment']
+
+def rowValues(row):
+    """
+    Get the values of a sqlite3.Row or row dict in column name order.
+    """
+    return [row[k] for k in sorted(row.keys())]
 
-    infoline = '%s/%s/%s/Tb:%s, (D:%.1f/T:%.1f)' % (
-	    CacheTypes[row['CacheType']],
-	    row['Container'][:3],
-	    last4(row['Code']),
-	    'Y' if row['HasTravelBug'] else 'N',
-	    row['Difficulty'], row['Terrain'])
+def fingerprintHash():
+    return hashlib.sha1('%s/%d/%s' % (FragmentVersion, TextLimit, sys.platform))
 
-    dates = 'Pl:%s, LF:%s' % (row['PlacedDate'], row['LastFoundDate'])
+# Key column, render method and fingerprint method of Converter for each
+# table. Methods are given by name, so that jobs for worker processes can be
+# pickled.
+Renderers = {
+    'caches': ('Code', 'processCache', 'cacheFingerprint'),
+    'waypoints': ('cCode', 'processWaypoint', 'waypointFingerprint'),
+}
 
-    coords = '%s %s' % (convlat(float(row['Latitude'])), convlon(float(row['Longitude'])))
+class Converter:
+    """
+    Convert one GSAK database. A Converter has its own database connection,
+    prefetch tables and log text cache, so that several can run in one
+    process, each in a thread of its own. It can be made in one thread and
+    used in another, but only by one thread at a time. The lookups from
+    load_lookups are only read, so they can be shared.
+
+    convert yields the rendered waypoints of the whole database. caches and
+    waypoints render rows that have already been queried, for callers that
+    want to count them first. Waypoints are rendered as GPX, or if gpi is
+    true, as GPI point records.
+    """
+    def __init__(self, dbfile, lookups, stream=False, logcache=LogCacheSize,
+	    dbprofile='default', immutable=False, indexfile=None, gpi=False):
+	self.dbfile = dbfile
+	self.lookups = lookups
+	self.cacheTypes, self.attributeText = lookups
+	self.stream = stream
+	self.logcache = logcache
+	self.dbprofile = dbprofile
+	self.immutable = immutable
+	self.gpi = gpi
+	self.conn = open_db(dbfile, dbprofile, immutable, True)
+	self.indexfile = None
+	self.areaFilter = False
+	if indexfile is not None:
+	    self.useIndex(indexfile)
+	else:
+	    self.initPrefetch()
+
+    def workerArgs(self):
+	"""
+	Get the arguments for the same Converter in a worker process.
+	"""
+	return (self.dbfile, self.lookups, self.stream, self.logcache,
+		self.dbprofile, self.immutable, self.indexfile, self.gpi)
+
+    def useIndex(self, indexfile):
+	"""
+	Only take the caches in the selection table of a spatial index.
+	"""
+	self.conn.execute('attach database ? as idx', (indexfile, ))
+	self.indexfile = indexfile
+	self.areaFilter = True
+	self.initPrefetch()
+
+    def initPrefetch(self):
+	conn, filtered = self.conn, self.areaFilter
+	self.logMemo = LogMemo(conn, self.logcache * 1024 * 1024)
+	self.textMemo = TextMemo(TextMemoSize * 1024 * 1024)
+	if self.stream:
+	    # Caches are processed in code order, so the other tables can be
+	    # read alongside in the same order instead of being prefetched.
+	    self.logsTable = StreamLogsTable(conn, filtered)
+	    self.cacheMemo = StreamCacheMemo(conn, filtered)
+	    self.attrTable = GroupCursor(conn,
+		    columns('attributes', AttrColumns) +
+		    selected('aCode', filtered) + ' order by aCode, rowid',
+		    'aCode')
+	    self.wayMemo = StreamWayMemo(conn, filtered)
+	else:
+	    self.logsTable = LogsTable(conn, filtered)
+	    self.cacheMemo = CacheMemo(conn, filtered)
+	    self.attrTable = AttrTable(conn, filtered)
+	    self.wayMemo = WayMemo(conn, filtered)
+
+    def close(self):
+	self.conn.close()
+
+    def packTables(self, codes):
+	"""
+	Get the cachememo, attribute and log rows of some caches, packed, to
+	send to a worker process with the caches.
+	"""
+	tables = []
+	for table in (self.cacheMemo, self.attrTable, self.logsTable):
+	    packed = {}
+	    for code in codes:
+		values = table.packed(code)
+		if values:
+		    packed[code] = values
+	    tables.append(packed)
+	return tables
+
+    def takeTables(self, tables):
+	"""
+	Use rows from packTables in a worker process, instead of prefetching
+	the tables.
+	"""
+	memo, attrs, logs = tables
+	self.cacheMemo = PackedTable(CacheMemoColumns, memo)
+	self.attrTable = PackedTable(AttrColumns, attrs)
+	self.logsTable = PackedTable(LogColumns, logs)
+
+    def last4(self, code):
+	"""
+	Summarize last 4 cache logs.
+	"""
+	types = records.column(LogColumns, self.logsTable.packed(code),
+		'lType', 4)
+
+	l4 = ''
+
+	for i in range(4):
+	    if i >= len(types):
+		l4 += '0'
+	    else:
+		l4 += LogConv.get(string.lower(types[i]), 'X')
+
+	return l4
+
+    def travelBugs(self, code):
+	"""
+	Get list of travel bugs.
+	"""
+	return dec(self.cacheMemo.getRow(code)['TravelBugs'])
+
+    def attribFmt(self, row):
+	text = self.attributeText.get(row['aId'],
+		lookupcache.UnknownAttribute)
+	return text[1 if row['aInc'] else 0]
+
+    def attribs(self, code):
+	"""
+	Get cache attributes.
+	"""
+	rows = self.attrTable.getRows(code)
+	return ', '.join([self.attribFmt(r) for r in rows])
+
+    def logText(self, logid):
+	return dec(self.logMemo.getLogText(logid))
+
+    def logFmt(self, row):
+	return """
+<font color=#0000FF>%s by %s %s</font> - %s%s%s<br><br>
+""" % (
+	    dec(row['lType']),
+	    enc(escAmp(dec(row['lBy']))),
+	    dec(row['lDate']),
+	    convlat(float(row['lLat'])) + ' ' if row['lLat'] != '' else '',
+	    convlon(float(row['lLon'])) + ' ' if row['lLon'] != '' else '',
+	    self.textMemo.apply(cleanLogText,
+		self.logMemo.getLogText(row['lLogId'])),
+	    )
 
-    cacheinfo = """
+    def logs(self, code, limit):
+	"""
+	Get cache logs, newest first, already run through cleanStr. Stop
+	once the text is longer than limit, since processCache will cut it
+	there anyway. Logs past that point are never unpacked or formatted
+	and their text is never fetched.
+	"""
+	values = self.logsTable.packed(code)
+	logids = records.column(LogColumns, values, 'lLogId')
+	n = len(LogColumns)
+	out = []
+	length = 0
+	start = 0
+	batch = LogBatch
+	while start < len(logids) and length <= limit:
+	    # Read the texts of the next few logs in one go, and unpack only
+	    # those logs.
+	    self.logMemo.fetch(logids[start:start + batch])
+	    for r in records.unpack(LogColumns,
+		    values[start * n:(start + batch) * n]):
+		if length > limit:
+		    break
+		s = cleanStr(self.logFmt(r))
+		if out:
+		    # Each log starts and ends with a newline. cleanStr on the
+		    # whole string would have collapsed the two into one space.
+		    s = s[1:]
+		out.append(s)
+		length += len(s)
+	    start += batch
+	    batch = min(batch * 2, LogBatchMax)
+	return ''.join(out)
+
+    def processCache(self, row):
+	"""
+	Process a record from the caches table. Generate GPX output for that
+	geocache.
+	"""
+	code = dec(row['Code'])
+	wptname = '%s/%s/%s' % (dec(row['SmartName']), self.cacheTypes[row['CacheType']], code)
+
+	status = ''
+	statusplain = ''
+
+	if row['TempDisabled']:
+	    status = '<font color=#FF0000>*** Temp Unavailable ***</font><br><br>'
+	    statusplain = '*** Temp Unavailable ***'
+
+	if row['Archived']:
+	    status = '<font color=#FF0000>*** Archived ***</font><br><br>'
+	    statusplain = '*** Archived ***'
+
+	name = escAmp(dec(row['Name']))
+	ownername = escAmp(dec(row['OwnerName']))
+
+	infoline = '%s/%s/%s/Tb:%s, (D:%.1f/T:%.1f)' % (
+		self.cacheTypes[row['CacheType']],
+		dec(row['Container'])[:3],
+		self.last4(code),
+		'Y' if row['HasTravelBug'] else 'N',
+		row['Difficulty'], row['Terrain'])
+
+	dates = 'Pl:%s, LF:%s' % (dec(row['PlacedDate']), dec(row['LastFoundDate']))
+
+	coords = '%s %s' % (convlat(float(row['Latitude'])), convlon(float(row['Longitude'])))
+
+	cacheinfo = """
 <font color=#FF0000>%s by %s</font><br>
 <font color=#008000>%s</font><br>
 <font color=#0000FF>%s</font><br>
 <font color=#FFA500>%s</font><br><br>
 """ % (
-	enc(name), enc(ownername),
-	infoline, dates, coords)
+	    enc(name), enc(ownername),
+	    infoline, dates, coords)
 
-    if row['HasTravelBug']:
-	tbstr = escAmp(travelBugs(row['Code']))
-	cacheinfo += """
+	if row['HasTravelBug']:
+	    tbstr = escAmp(self.travelBugs(row['Code']))
+	    cacheinfo += """
 <font color=#FF00FF>**Travel Bugs**%s</font><br><br>
 """ % enc(tbstr)
 
-    attr = attribs(row['Code'])
-    if attr != '':
-	cacheinfo += """
+	attr = self.attribs(row['Code'])
+	if attr != '':
+	    cacheinfo += """
 <font color=#00BFFF>**Attributes** %s</font><br><br>
 """ % attr
 
-    # This is some cache information in plain text that the Nuvi will display
-    # before you touch the "More" button.
-    plaincacheinfo = """
+	# This is some cache information in plain text that the Nuvi will display
+	# before you touch the "More" button.
+	plaincacheinfo = """
 %s
 %s
 %s
 %s by %s
 %s
 """ % (
-	statusplain, 
-	coords, 
-	infoline, 
-	enc(name), enc(ownername), 
-	dates)
+	    statusplain, 
+	    coords, 
+	    infoline, 
+	    enc(name), enc(ownername), 
+	    dates)
 
-    ( longdesc, shortdesc, hints ) = getText(row['Code'])
+	# Descriptions and hints are often shared by a series of caches, so
+	# they are sanitized from the undecoded text, through the memo.
+	memo = self.cacheMemo.getRow(row['Code'])
 
-    hints = "<font color=#008000>Hint: %s</font><br>" % enc(escAmp(hints))
+	hints = self.textMemo.apply(cleanHints, memo['Hints'])
 
-    alldesc = escAmp(enc(shortdesc + '<br>' + longdesc))
+	alldesc = self.textMemo.apply(cleanDescription,
+		memo['ShortDescription'], memo['LongDescription'])
 
-    logstr = cleanStr(logs(row['Code']))
-    hints = cleanStr(hints)
+	# If alldesc was cut off, this is longer than TextLimit before the
+	# '<br>', so only the part before the cut ends up in finalstr.
+	combdesc = cleanStr(status + escAmp(cacheinfo) + "Description: " + alldesc + '<br>')
 
-    alldesc = cleanHTML(alldesc)
-
-    combdesc = cleanStr(status + escAmp(cacheinfo) + "Description: " + alldesc + '<br>')
-
-    if len(combdesc) + len(hints) > TextLimit:
-	finalstr = truncate(combdesc, TextLimit - len(hints) - 10) + cleanStr('<br>**DESCRIPTION CUT**<br>') + hints
-    else:
-	finalstr = truncate(combdesc + hints + logstr, TextLimit)
+	if len(combdesc) + len(hints) > TextLimit:
+	    finalstr = truncate(combdesc, TextLimit - len(hints) - 10) + cleanStr('<br>**DESCRIPTION CUT**<br>') + hints
+	else:
+	    logstr = self.logs(row['Code'], TextLimit - len(combdesc) - len(hints))
+	    finalstr = truncate(combdesc + hints + logstr, TextLimit)
 
+	if self.gpi:
+	    return gpiwriter.point(float(row['Latitude']),
+		    float(row['Longitude']), wptname, finalstr)
 
-    return """
+	return """
 <wpt lat='%s' lon='%s'><ele>0.00</ele><time>2008-05-01T00:00:00Z</time>
 <name>%s</name><cmt></cmt><desc>%s</desc>
 <link href="futurefeature.jpg"/><sym>Information</sym>
@@ -475,48 +1209,51 @@ def processCache(row):
 <gpxx:Address><gpxx:PostalCode>%s</gpxx:PostalCode></gpxx:Address>
 </gpxx:WaypointExtension></extensions></wpt>
 """ % (
-	row['Latitude'], row['Longitude'],
-	wptname, finalstr, cleanStr(escAmp(plaincacheinfo)),
-	)
-
-def childComment(code):
-    curs = conn.cursor()
-    curs.execute('select cComment from waymemo where cCode=? limit 1', (code, ))
-    row = curs.fetchone()
-    curs.close()
-    return row['cComment']
-
-def parentSmart(code):
-    curs = conn.cursor()
-    curs.execute('select smartName from caches where code=? limit 1', (code, ))
-    row = curs.fetchone()
-    curs.close()
-    return row['smartName']
-
-def processWaypoint(row):
-    """
-    Generate GPX for an additional waypoint.
-    """
-    wptname = '%s - %s' % (row['cCode'], row['cType'])
-
-    ccomment = cleanHTML(escAmp(childComment(row['cCode'])))
-
-    parentinfo = '%s - (%s)' % (
-	    row['cParent'],
-	    parentSmart(row['cParent']),
+	    dec(row['Latitude']), dec(row['Longitude']),
+	    wptname, finalstr, cleanStr(escAmp(plaincacheinfo)),
 	    )
 
-    childdesc = """
+    def waypointRows(self, rows):
+	"""
+	Add the waypoint comment to waypoint rows, so that processWaypoint
+	does not have to look it up. The SmartName of the parent cache comes
+	with the row from queryWaypoints.
+	"""
+	for row in rows:
+	    row = rowDict(row)
+	    row['cComment'] = self.wayMemo.getComment(row['cCode'])
+	    yield row
+
+    def processWaypoint(self, row):
+	"""
+	Generate GPX for an additional waypoint. The row comes from
+	waypointRows.
+	"""
+	ctype = dec(row['cType'])
+	wptname = '%s - %s' % (dec(row['cCode']), ctype)
+
+	ccomment = self.textMemo.apply(cleanComment, row['cComment'])
+
+	parentinfo = '%s - (%s)' % (
+		dec(row['cParent']),
+		dec(row['ParentSmart']),
+		)
+
+	childdesc = """
 This is a child waypoint for Cache <font color=#0000FF>%s</font><br><br>Type: %s<br>Comment: %s
 """ % (
-	parentinfo,
-	enc(row['cType']),
-	enc(ccomment),
-	)
+	    parentinfo,
+	    enc(ctype),
+	    enc(ccomment),
+	    )
 
-    childdesc = cleanStr(childdesc)
+	childdesc = cleanStr(childdesc)
 
-    return """
+	if self.gpi:
+	    return gpiwriter.point(float(row['cLat']), float(row['cLon']),
+		    wptname, childdesc)
+
+	return """
 <wpt lat='%s' lon='%s'><ele>0.00</ele><time>2008-05-01T00:00:00Z</time>
 <name>%s</name><cmt></cmt><desc>%s</desc><link href="futurefeature.jpg"/>
 <sym>Information</sym>
@@ -525,37 +1262,162 @@ This is a child waypoint for Cache <font color=#0000FF>%s</font><br><br>Type: %s
 <gpxx:Address><gpxx:PostalCode>Child of %s</gpxx:PostalCode></gpxx:Address>
 </gpxx:WaypointExtension></extensions></wpt>
 """ % (
-	row['cLat'], row['cLon'],
-	wptname, childdesc, parentinfo,
-	)
-
-
-def appDataPath():
-    """
-    Try to get the Windows application data path by various means.
-    """
-    s = os.environ.get('APPDATA')
-    if s is not None:
-	return s
-
-    userprof = os.environ.get('USERPROFILE')
-    if userprof is not None:
-	return userprof + '/Application Data'
-    
-    homedrive = os.environ.get('HOMEDRIVE')
-    homepath = os.environ.get('HOMEPATH')
-
-    if homedrive is not None and homepath is not None:
-	return '%s%s/Application Data' % (homedrive, homepath)
-
-    if homedrive is None:
-	homedrive = 'C:'
+	    dec(row['cLat']), dec(row['cLon']),
+	    wptname, childdesc, parentinfo,
+	    )
 
-    username = os.environ.get('USERNAME')
-    if username is not None:
-	return '%s/Documents and Settings/%s/Application Data'
+    def cacheFingerprint(self, row):
+	"""
+	Fingerprint everything that processCache reads for a cache. The
+	memo, attribute and log rows are hashed as they are kept, packed.
+	The texts of the logs are not read for this. Each log row has a
+	checksum of its text instead, worked out by SQLite.
+	"""
+	code = row['Code']
+	h = fingerprintHash()
+	h.update(repr(rowValues(row)))
+	h.update(repr(self.cacheTypes[row['CacheType']]))
+	h.update(repr(self.cacheMemo.packed(code)))
+	attrs = self.attrTable.packed(code)
+	h.update(repr(attrs))
+	for r in records.unpack(AttrColumns, attrs):
+	    h.update(repr(self.attribFmt(r)))
+	h.update(repr(self.logsTable.packed(code)))
+	return h.hexdigest()
+
+    def waypointFingerprint(self, row):
+	"""
+	Fingerprint everything that processWaypoint reads for a waypoint.
+	"""
+	h = fingerprintHash()
+	h.update(repr(rowValues(row)))
+	return h.hexdigest()
+
+    def renderCached(self, job):
+	"""
+	Render a row unless its fingerprint matches that of the stored
+	fragment. Returns the key, the fingerprint and the fragment, or None
+	for the fragment if the stored one can be reused.
+	"""
+	kind, row, oldfp = job
+	keycol, func, fpfunc = Renderers[kind]
+	fp = getattr(self, fpfunc)(row)
+	if fp == oldfp:
+	    return (row[keycol], fp, None)
+	return (row[keycol], fp, getattr(self, func)(row))
+
+    def render(self, pool, name, rows, codeOf=None):
+	"""
+	Render rows with the method called name, in this process or spread
+	across a pool of worker processes set up by init_worker. Either way,
+	results come back in the order of rows. If codeOf is given, it gets
+	the cache code of a row, and the rows of the other tables that the
+	cache needs are sent to the workers along with it.
+	"""
+	if pool is None:
+	    func = getattr(self, name)
+	    for row in rows:
+		yield func(row)
+	    return
+
+	# Hand rows to the pool a batch at a time so that the next batch is
+	# already being rendered while we collect the results of this one.
+	rows = iter(rows)
+	pending = None
+	while True:
+	    batch = list(itertools.islice(rows, RenderBatch))
+	    nextbatch = None
+	    if batch:
+		chunks = []
+		for i in range(0, len(batch), RenderChunk):
+		    chunk = batch[i:i + RenderChunk]
+		    tables = None
+		    if codeOf is not None:
+			tables = self.packTables([codeOf(row) for row in chunk])
+		    chunks.append((name, chunk, tables))
+		nextbatch = pool.map_async(renderRows, chunks, 1)
+	    if pending is not None:
+		for wpts, (hits, misses, memohits, memomisses, prof) in \
+			pending.get():
+		    self.logMemo.cache.hits += hits
+		    self.logMemo.cache.misses += misses
+		    self.textMemo.cache.hits += memohits
+		    self.textMemo.cache.misses += memomisses
+		    if prof is not None:
+			profiler.merge(prof)
+		    for wpt in wpts:
+			yield wpt
+	    if nextbatch is None:
+		break
+	    pending = nextbatch
+
+    def renderTable(self, pool, frags, kind, rows):
+	"""
+	Render rows from the caches or waypoints table. If there is a
+	fragment cache, reuse the stored fragments of rows that have not
+	changed and store the rest. Fragments of rows that are gone are left
+	for FragmentCache.evictUnused. Yields the key of each row, its
+	waypoint and whether the waypoint was rendered rather than reused.
+	"""
+	keycol, func, fpfunc = Renderers[kind]
+	if pool is not None:
+	    rows = itertools.imap(rowDict, rows)
+
+	# Workers get the other tables of each cache from here, so that each
+	# of them doesn't have to prefetch the whole of them.
+	codeOf = None
+	if pool is not None and kind == 'caches':
+	    codeOf = operator.itemgetter(keycol)
+
+	if frags is None:
+	    # Rows are taken ahead of the results, so remember their keys.
+	    keys = collections.deque()
+	    def noteKeys(rows):
+		for row in rows:
+		    keys.append(row[keycol])
+		    yield row
+	    for wpt in self.render(pool, func, noteKeys(rows), codeOf):
+		yield keys.popleft(), wpt, True
+	    return
+
+	oldfps = frags.fingerprints(kind)
+	jobs = ((kind, row, oldfps.get(row[keycol])) for row in rows)
+	if codeOf is not None:
+	    codeOf = lambda job: job[1][keycol]
+	for key, fp, wpt in self.render(pool, 'renderCached', jobs, codeOf):
+	    if wpt is None:
+		yield key, frags.get(kind, key), False
+	    else:
+		frags.put(kind, key, fp, wpt)
+		yield key, wpt, True
+
+    def caches(self, rows, pool=None, frags=None):
+	"""
+	Render caches from queryCaches, as renderTable does.
+	"""
+	return self.renderTable(pool, frags, 'caches', rows)
+
+    def waypoints(self, rows, pool=None, frags=None):
+	"""
+	Render additional waypoints from queryWaypoints, as renderTable
+	does.
+	"""
+	return self.renderTable(pool, frags, 'waypoints',
+		self.waypointRows(rows))
+
+    def convert(self, pool=None, frags=None):
+	"""
+	Render all caches, then all additional waypoints. Yields the key of
+	each, its waypoint and whether it was rendered rather than reused.
+	"""
+	curs = self.conn.cursor()
+	rowcount, rows = queryCaches(curs, self.stream, self.areaFilter)
+	for item in self.caches(rows, pool, frags):
+	    yield item
+	rowcount, rows = queryWaypoints(curs, self.stream, self.areaFilter)
+	for item in self.waypoints(rows, pool, frags):
+	    yield item
 
-    return ''
 
 def writeicon(fname, data):
     """
@@ -567,88 +1429,1052 @@ def writeicon(fname, data):
     f.write(base64.b64decode(data))
     f.close()
 
-def init_prefetch():
-    global logsTable, cacheMemo, attrTable, logMemo
-    logsTable = LogsTable()
-    cacheMemo = CacheMemo()
-    attrTable = AttrTable()
-    logMemo = LogMemo()
+def load_lookups(gsakdir):
+    """
+    Get the cache types and attributes from GSAK's static database, or
+    from the copy saved from it if it has not changed. Returns the cache
+    type abbreviations by code and the attribute texts by id, as (text when
+    off, text when on).
+    """
+    staticfile = gsakdb.staticPath(gsakdir)
+    try:
+	cachetypes, attributes, rebuilt = lookupcache.load(gsakdir)
+    except sqlite3.OperationalError, e:
+	show_error('Error opening database %s: %s' % (staticfile, e.message))
+	sys.exit(2)
+    if rebuilt:
+	show_message('Read cache types and attributes from %s' % staticfile)
+    return cachetypes, attributes
+
+def textCrc(text):
+    """
+    Get the checksum of a log text for logsQuery. Logs without a text have
+    none.
+    """
+    if text is None:
+	return None
+    return zlib.crc32(text)
 
+def open_db(dbfile, dbprofile='default', immutable=False, anyThread=False):
+    """
+    Open a GSAK database and set up the connection for reading.
+    """
+    db = gsakdb.connect(dbfile, dbprofile, immutable, anyThread)
+
+    # Leave text undecoded. Values are decoded with dec when rendered.
+    db.text_factory = str
+
+    db.create_function('textcrc', 1, textCrc)
+
+    return db
+
+def init_worker(args, profile):
+    """
+    Set up a rendering process with a Converter of its own, made from the
+    arguments given by Converter.workerArgs. Its tables are only read
+    from the database if the parent does not send their rows.
+    """
+    global worker
+    if profile:
+	enable_profile()
+    worker = Converter(*args)
 
-def process_db(dbname, outname, outdir, gsakdir):
-    global conn
+def renderRows(job):
+    """
+    Render a chunk of rows in a worker process. Also returns the hits and
+    misses of the log text cache and the text memo since the last chunk,
+    so that the parent can report them.
+    """
+    name, rows, tables = job
+    if tables is not None:
+	worker.takeTables(tables)
+    func = getattr(worker, name)
+    wpts = [func(row) for row in rows]
+    cache = worker.logMemo.cache
+    memo = worker.textMemo.cache
+    stats = (cache.hits, cache.misses, memo.hits, memo.misses,
+	    profiler.take() if profiler is not None else None)
+    cache.hits = cache.misses = memo.hits = memo.misses = 0
+    return wpts, stats
+
+def rowDict(row):
+    """
+    Convert a sqlite3.Row to a dict so that it can be sent to a worker
+    process.
+    """
+    return dict([(k, row[k]) for k in row.keys()])
 
-    init_prefetch()
+class ReadAhead(threading.Thread):
+    """
+    Read caches, and the texts of their logs, ahead of rendering. This runs
+    in a thread with its own connection to the database of a Converter.
+    SQLite lets other threads run while it waits for the disk, so rendering
+    goes on meanwhile. If logIds is given, it is called with a cache code and
+    LogBatch to get the ids of the logs to read. Those are the newest logs,
+    which logs reads first. The rest are left to logs, which often stops
+    before reaching them, so reading them ahead would only crowd the log
+    text cache.
+    """
+    def __init__(self, conv, logIds=None):
+	threading.Thread.__init__(self)
+	self.daemon = True
+	self.args = (conv.dbfile, conv.dbprofile, conv.immutable,
+		conv.indexfile, conv.stream)
+	self.logMemo = conv.logMemo
+	self.logIds = logIds
+	self.queue = Queue.Queue(PipeDepth)
+	self.stopped = False
+
+    def run(self):
+	try:
+	    dbfile, dbprofile, immutable, indexfile, stream = self.args
+	    db = open_db(dbfile, dbprofile, immutable)
+	    if indexfile is not None:
+		db.execute('attach database ? as idx', (indexfile, ))
+	    rowcount, rows = queryCaches(db.cursor(), stream,
+		    indexfile is not None, True)
+	    self.put(('count', rowcount))
+	    while True:
+		chunk = rows.fetchmany(PipeChunk)
+		if not chunk:
+		    break
+		texts = ()
+		if self.logIds is not None:
+		    ids = [logid for row in chunk
+			    for logid in self.logIds(row['Code'], LogBatch)]
+		    texts = list(readLogTexts(db, ids))
+		if not self.put(('rows', (chunk, texts))):
+		    break
+	    db.close()
+	    self.put(('end', None))
+	except Exception:
+	    self.put(('error', sys.exc_info()))
+
+    def put(self, item):
+	"""
+	Wait for room in the queue, unless stopped. Returns whether the item
+	was queued.
+	"""
+	while not self.stopped:
+	    try:
+		self.queue.put(item, True, 0.5)
+		return True
+	    except Queue.Full:
+		pass
+	return False
+
+    def get(self):
+	"""
+	Get the next item as (kind, value). Errors in the thread are raised
+	here.
+	"""
+	kind, value = self.queue.get()
+	if kind == 'error':
+	    raise value[0], value[1], value[2]
+	return kind, value
+
+    def rows(self):
+	"""
+	Yield the caches that were read, putting the texts of their logs into
+	the log text cache.
+	"""
+	while True:
+	    kind, value = self.get()
+	    if kind == 'end':
+		return
+	    chunk, texts = value
+	    self.logMemo.add(texts)
+	    for row in chunk:
+		yield row
+
+    def stop(self):
+	self.stopped = True
+
+class WriteBehind(threading.Thread):
+    """
+    Write waypoints to the GPX files in a thread of their own. Takes the
+    place of GPXFiles in write_rows. Errors in the thread are raised by
+    write or finish.
+    """
+    def __init__(self, files):
+	threading.Thread.__init__(self)
+	self.daemon = True
+	self.files = files
+	self.queue = Queue.Queue(PipeDepth)
+	self.chunk = []
+	self.error = None
+	self.stopped = False
+
+    def run(self):
+	while True:
+	    chunk = self.queue.get()
+	    if chunk is None:
+		return
+	    if self.error is None and not self.stopped:
+		try:
+		    for item in chunk:
+			self.files.write(*item)
+		except Exception:
+		    # Keep taking chunks, so that write does not wait forever.
+		    self.error = sys.exc_info()
+
+    def raiseError(self):
+	if self.error is not None:
+	    raise self.error[0], self.error[1], self.error[2]
+
+    def write(self, shard, wpt, changed=True):
+	self.chunk.append((shard, wpt, changed))
+	if len(self.chunk) >= PipeChunk:
+	    self.raiseError()
+	    self.queue.put(self.chunk)
+	    self.chunk = []
+
+    def finish(self):
+	"""
+	Wait until everything has been written.
+	"""
+	self.queue.put(self.chunk)
+	self.queue.put(None)
+	self.join()
+	self.raiseError()
+
+    def stop(self):
+	"""
+	Drop the chunks that have not been written yet and wait for the
+	thread to end, so that nothing is written once the files have been
+	aborted.
+	"""
+	self.stopped = True
+	self.queue.put(None)
+	self.join()
+
+def show_message(msg):
+    """
+    Print a message, or send it to the parent process.
+    """
+    if progressQueue is None:
+	print msg
+    else:
+	progressQueue.put((progressName, 'message', msg))
 
-    if outname == dbname:
-        print 'Processing database %s...' % dbname
+def show_error(msg):
+    """
+    Print an error message to stderr, or send it to the parent process.
+    """
+    if progressQueue is None:
+	print >> sys.stderr, msg
     else:
-        print 'Processing database %s to %s...' % (dbname, outname)
+	progressQueue.put((progressName, 'error', msg))
 
-    dbfile = '%s/%s/data/%s/sqlite.db3' % (appDataPath(), gsakdir, dbname)
+def show_progress(recordnum, rowcount, what):
+    """
+    Update the progress display, or send progress to the parent process.
+    """
+    if progressQueue is None:
+	print "\rNow processing: %d of %d %s" % (recordnum, rowcount, what),
+    elif recordnum % 1000 == 0 or recordnum == rowcount:
+	progressQueue.put((progressName, 'progress',
+	    '%d of %d %s' % (recordnum, rowcount, what)))
 
-    try:
-	conn = sqlite3.connect(dbfile)
-    except sqlite3.OperationalError, e:
-	print >> sys.stderr, 'Error opening database %s: %s' % (dbfile, e.message)
-	sys.exit(2)
+def write_rows(files, items, rowcount, what, shardOf):
+    """
+    Write rendered waypoints from Converter.renderTable to the GPX file of
+    their shard, with a progress display.
+    """
+    recordnum = 0
+    for key, wpt, changed in items:
+	recordnum += 1
+	if recordnum % 10 == 0:
+	    show_progress(recordnum, rowcount, what)
+	files.write(shardOf(key), wpt, changed)
+
+    show_progress(recordnum, rowcount, what)
+    if progressQueue is None:
+	print "\nDone"
+
+# Functions and methods timed by --profile, and the stage each one is
+# counted under.
+ProfileFunctions = [
+    ('open_db', 'sqlite'),
+    ('queryCaches', 'sqlite'),
+    ('queryWaypoints', 'sqlite'),
+    ('cleanHTML', 'cleanHTML'),
+    ('cleanDescription', 'cleanHTML'),
+    ('cleanStr', 'cleanStr'),
+]
+ProfileMethods = [
+    (Converter, 'logs', 'logs'),
+    (Converter, 'attribs', 'attribs'),
+    (Converter, 'cacheFingerprint', 'fingerprint'),
+    (Converter, 'waypointFingerprint', 'fingerprint'),
+    (Converter, 'processWaypoint', 'processWaypoint'),
+    (GroupCursor, 'getRows', 'sqlite'),
+    (LogMemo, 'fetch', 'sqlite'),
+    (LogsTable, 'queryData', 'prefetch'),
+    (CacheMemo, 'queryData', 'prefetch'),
+    (AttrTable, 'queryData', 'prefetch'),
+    (WayMemo, 'queryData', 'prefetch'),
+    (gpxwriter.GPXWriter, 'flush', 'write'),
+    (gpxwriter.GPXWriter, 'close', 'write'),
+]
+
+def enable_profile():
+    """
+    Start timing the stages of processing. This replaces the functions
+    and methods to be timed with wrappers, so that there is no overhead
+    at all without --profile. If already started, start over.
+    """
+    global profiler
+    if profiler is not None:
+	profiler.reset()
+	return
+    profiler = stageprof.StageProfiler(ProfileTop)
+    g = globals()
+    for name, stage in ProfileFunctions:
+	g[name] = profiler.wrap(g[name], stage)
+    for cls, name, stage in ProfileMethods:
+	setattr(cls, name, profiler.wrap(getattr(cls, name).im_func, stage))
+    Converter.processCache = profiler.wrap(Converter.processCache.im_func,
+	    'processCache', lambda self, row: row['Code'])
+
+def write_profile(fname, dbname, elapsed, jobs):
+    """
+    Save the --profile report as JSON.
+    """
+    report = profiler.report()
+    report['database'] = dbname
+    report['elapsed'] = elapsed
+    report['jobs'] = jobs
+    f = open(fname, 'w')
+    json.dump(report, f, indent=1, sort_keys=True)
+    f.close()
 
-    outfname = '%s/%s GSAK.gpx' % (outdir, outname)
+def dbNames(dbname):
+    """
+    Get the names of the databases in a process_db job as a list.
+    """
+    if isinstance(dbname, list):
+	return dbname
+    return [dbname]
+
+def process_db(dbname, outname, outdir, gsakdir, stream=False, jobs=1,
+	incremental=False, logcache=LogCacheSize, compress=False,
+	profile=False, dbprofile='default', immutable=False, tilesize=None,
+	maxpoints=None, areas=None, pipeline=False, gpi=False):
+    """
+    Convert a database, or a list of databases merged into one output.
+    """
+    if profile:
+	enable_profile()
+	start = time.time()
+
+    dbnames = dbNames(dbname)
+    if len(dbnames) > 1:
+	show_message('Merging databases %s to %s...' % (', '.join(dbnames),
+	    outname))
+    elif outname == dbnames[0]:
+	show_message('Processing database %s...' % dbnames[0])
+    else:
+	show_message('Processing database %s to %s...' % (dbnames[0], outname))
 
-    outf = open(outfname, 'w')
+    lookups = load_lookups(gsakdir)
 
-    print >>outf, """<?xml version='1.0' encoding='Windows-1252' standalone='no' ?>
+    convs = []
+    try:
+	for name in dbnames:
+	    dbfile = gsakdb.dbPath(gsakdir, name)
+	    try:
+		convs.append(Converter(dbfile, lookups, stream, logcache,
+		    dbprofile, immutable, gpi=gpi))
+	    except sqlite3.OperationalError, e:
+		show_error('Error opening database %s: %s' % (dbfile, e.message))
+		sys.exit(2)
+
+	if gpi:
+	    files = GPIFiles(outdir, outname)
+	else:
+	    files = GPXFiles(outdir, outname, compress)
+	try:
+	    write_gpx(convs, dbnames, files, outdir, outname, jobs, incremental,
+		    profile, tilesize, maxpoints, areas, pipeline)
+	except:
+	    files.abort()
+	    raise
+    finally:
+	for conv in convs:
+	    conv.close()
+    show_message(files.stats)
+
+    if profile:
+	profname = '%s/%s GSAK.profile.json' % (outdir, outname)
+	write_profile(profname, dbname, time.time() - start, jobs)
+	show_message('Wrote profile to %s' % profname)
+
+GPXHeader = """<?xml version='1.0' encoding='Windows-1252' standalone='no' ?>
 <gpx xmlns='http://www.topografix.com/GPX/1/1' xmlns:gpxx = 'http://www.garmin.com/xmlschemas/GpxExtensions/v3' creator='Pilotsnipes' version='1.1' xmlns:xsi = 'http://www.w3.org/2001/XMLSchema-instance' xsi:schemaLocation='http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd http://www.garmin.com/xmlschemas/GpxExtensions/v3 http://www8.garmin.com/xmlschemas/GpxExtensions/v3/GpxExtensionsv3.xsd'>
 <metadata>
 <desc>Pilotsnipes GPX output for Nuvi</desc>
 <link href='http://pilotsnipes.googlepages.com'><text>Tourguide Compatible.</text></link>
 <time>2008-05-01T00:00:00Z</time>
-<bounds maxlat='53.000000' maxlon='-6.0000' minlat='53.000000' minlon='-6.000000'/>
-</metadata>
+%s</metadata>
+
 
 """
 
-    recordnum = 0
+GPXBounds = "<bounds maxlat='%.6f' maxlon='%.6f' minlat='%.6f' minlon='%.6f'/>\n"
 
-    conn.row_factory = sqlite3.Row
+GPXFooter = "</gpx>\n"
 
-    # Custom text factory ignores Unicode characters that cannot be decoded from utf-8.
-    conn.text_factory = lambda x: unicode(x, "utf-8", "ignore")
+class GPXFiles:
+    """
+    The GPX files written for a database: just one, or one per shard. The
+    shard named '' is the plain outname GSAK.gpx.
+    """
+    def __init__(self, outdir, outname, compress):
+	self.outdir = outdir
+	self.outname = outname
+	self.compress = compress
+	self.writers = {}
+	self.changed = set()
+	# Bounds of the points in each shard, as [minlat, minlon, maxlat,
+	# maxlon].
+	self.bounds = {}
+
+    def fileName(self, shard, ext):
+	name = self.outname
+	if shard:
+	    name = '%s %s' % (self.outname, shard)
+	return '%s/%s GSAK.%s' % (self.outdir, name, ext)
+
+    def gpxName(self, shard):
+	return self.fileName(shard, 'gpx.gz' if self.compress else 'gpx')
+
+    def fragmentCache(self):
+	"""
+	Open the store of rendered waypoints for --incremental.
+	"""
+	return fragcache.FragmentCache(self.fileName('', 'cache'))
+
+    def open(self, shard):
+	w = self.writers.get(shard)
+	if w is None:
+	    w = gpxwriter.GPXWriter(self.gpxName(shard), self.compress)
+	    bounds = ''
+	    if shard in self.bounds:
+		minlat, minlon, maxlat, maxlon = self.bounds[shard]
+		bounds = GPXBounds % (maxlat, maxlon, minlat, minlon)
+	    w.write(GPXHeader % bounds)
+	    self.writers[shard] = w
+	return w
+
+    def write(self, shard, wpt, changed=True):
+	"""
+	Add a waypoint to a shard. changed tells whether it is different
+	from the last run.
+	"""
+	w = self.open(shard)
+	w.write(wpt)
+	w.write('\n')
+	if changed:
+	    self.changed.add(shard)
+
+    def close(self, keep=()):
+	"""
+	Finish the files and write their icons. Shards in keep whose
+	waypoints have not changed are left as they were from the last run.
+	Returns the shards that were written.
+	"""
+	written = []
+	for shard in sorted(self.writers):
+	    w = self.writers[shard]
+	    if shard in keep and shard not in self.changed and \
+		    os.path.exists(self.gpxName(shard)):
+		w.abort()
+		continue
+	    w.write(GPXFooter)
+	    w.close()
+	    writeicon(self.fileName(shard, 'bmp'), nuvifiles.cacheBMP)
+	    writeicon(self.fileName(shard, 'jpg'), nuvifiles.cacheJPG)
+	    written.append(shard)
+	self.stats = gpxwriter.stats(
+		[self.writers[shard] for shard in written])
+	self.writers = {}
+	return written
+
+    def abort(self):
+	for w in self.writers.values():
+	    w.abort()
+	self.writers = {}
+
+    def remove(self, shard):
+	"""
+	Delete the files of a shard that is no longer needed.
+	"""
+	for name in [self.fileName(shard, 'gpx'),
+		self.fileName(shard, 'gpx.gz'), self.fileName(shard, 'gpi'),
+		self.fileName(shard, 'bmp'), self.fileName(shard, 'jpg')]:
+	    if os.path.exists(name):
+		os.remove(name)
+
+class GPIFiles(GPXFiles):
+    """
+    The GPI files written for a database, named and split up like the GPX
+    files, ready to be copied to the device. Each is what POI Loader would
+    make of the GPX file. The points of a shard are kept until it is
+    closed, since a GPI file starts with the size of everything in it.
+    Their records wait in a temporary file in the output directory, and
+    only the position of each point and where its record is are kept in
+    memory.
+    """
+    def __init__(self, outdir, outname):
+	GPXFiles.__init__(self, outdir, outname, False)
+	self.points = {}
+	self.spool = None
+	self.spoolSize = 0
+	self.start = time.time()
+
+    def gpxName(self, shard):
+	return self.fileName(shard, 'gpi')
+
+    def fragmentCache(self):
+	return fragcache.FragmentCache(self.fileName('', 'gpi.cache'), True)
+
+    def open(self, shard):
+	return self.points.setdefault(shard, [])
+
+    def write(self, shard, wpt, changed=True):
+	if self.spool is None:
+	    self.spool = tempfile.TemporaryFile(dir=self.outdir)
+	self.spool.write(wpt)
+	self.open(shard).append(gpiwriter.pointPosition(wpt) +
+		(self.spoolSize, len(wpt)))
+	self.spoolSize += len(wpt)
+	if changed:
+	    self.changed.add(shard)
+
+    def closeSpool(self):
+	if self.spool is not None:
+	    self.spool.close()
+	    self.spool = None
+	    self.spoolSize = 0
+
+    def close(self, keep=()):
+	"""
+	Write the files, as GPXFiles.close does. POI Loader names the
+	category of the points after the file.
+	"""
+	bmp = gpiwriter.bitmap(base64.b64decode(nuvifiles.cacheBMP))
+	written = []
+	writers = []
+	for shard in sorted(self.points):
+	    fname = self.gpxName(shard)
+	    if shard in keep and shard not in self.changed and \
+		    os.path.exists(fname):
+		continue
+	    w = gpxwriter.GPXWriter(fname, binary=True)
+	    w.start = self.start
+	    try:
+		name = os.path.basename(fname)
+		gpiwriter.write(w, name, name[:-len('.gpi')],
+			self.points[shard], self.spool, bmp)
+	    except:
+		w.abort()
+		raise
+	    w.close()
+	    writers.append(w)
+	    written.append(shard)
+	self.stats = gpxwriter.stats(writers)
+	self.points = {}
+	self.closeSpool()
+	return written
+
+    def abort(self):
+	self.points = {}
+	self.closeSpool()
+
+def queryBounds(convs):
+    """
+    Get the bounds of the caches and waypoints of the Converters when the
+    output is not split, as planOutput does, from SQL aggregates rather
+    than by reading every position. Positions that are not numbers are
+    left out.
+    """
+    bounds = None
+    for conv in convs:
+	for table, code, lat, lon in [
+		('caches', 'Code', 'Latitude', 'Longitude'),
+		('waypoints', 'cParent', 'cLat', 'cLon')]:
+	    where = selected(code, conv.areaFilter)
+	    where += ' and ' if where else ' where '
+	    where += "%s glob '*[0-9]*' and %s glob '*[0-9]*'" % (lat, lon)
+	    curs = conv.conn.cursor()
+	    curs.execute('select min(cast(%s as real)), min(cast(%s as real)), '
+		    'max(cast(%s as real)), max(cast(%s as real)) from %s%s' % (
+		    lat, lon, lat, lon, table, where))
+	    row = curs.fetchone()
+	    if row[0] is None:
+		continue
+	    if bounds is None:
+		bounds = list(row)
+	    else:
+		bounds = [min(bounds[0], row[0]), min(bounds[1], row[1]),
+		    max(bounds[2], row[2]), max(bounds[3], row[3])]
+    if bounds is None:
+	return {}
+    return {'': bounds}
+
+def planOutput(convs, tilesize, maxpoints):
+    """
+    Decide which shard each cache of the Converters goes in, if the output
+    is split, and get the bounds of the caches and waypoints in each shard.
+    Returns a dict of shard name by cache code, and by 'waypoints/' and
+    the code for additional waypoints, or None, and a dict of bounds by
+    shard name.
+    """
+    if not tilesize and not maxpoints:
+	# Don't read in every position just for the bounds, so that memory
+	# use in --stream mode only depends on the largest cache when the
+	# output is not split.
+	return None, queryBounds(convs)
+
+    children = {}
+    points = []
+    for conv in convs:
+	curs = conv.conn.cursor()
+	curs.execute('select cParent, cCode, cLat, cLon from waypoints' +
+		selected('cParent', conv.areaFilter))
+	for row in curs:
+	    try:
+		pos = (float(row[2]), float(row[3]))
+	    except ValueError:
+		pos = None
+	    children.setdefault(row[0], []).append((row[1], pos))
+	curs.execute('select Code, Latitude, Longitude from caches' +
+		selected('Code', conv.areaFilter))
+	points.extend([(row[0], float(row[1]), float(row[2]),
+	    1 + len(children.get(row[0], []))) for row in curs])
+
+    plan = shards.plan(points, tilesize, maxpoints)
+
+    bounds = {}
+    for code, lat, lon, weight in points:
+	shard = plan[code]
+	positions = [(lat, lon)]
+	# Waypoints go in the same shard as their cache.
+	for child, pos in children.get(code, []):
+	    plan['waypoints/' + child] = shard
+	    positions.append(pos)
+	for pos in positions:
+	    if pos is None:
+		continue
+	    b = bounds.get(shard)
+	    if b is None:
+		bounds[shard] = [pos[0], pos[1], pos[0], pos[1]]
+	    else:
+		b[0] = min(b[0], pos[0])
+		b[1] = min(b[1], pos[1])
+		b[2] = max(b[2], pos[0])
+		b[3] = max(b[3], pos[1])
+    return plan, bounds
+
+def queryCaches(curs, stream, filtered, lazy=False):
+    """
+    Get the number of caches and the caches to process, only those picked
+    by area if filtered. In stream mode, or if lazy is set, the caches are
+    read as they are taken rather than all at once.
+    """
+    where = selected('Code', filtered)
+    if stream or lazy:
+	curs.execute('select count(*) from caches' + where)
+	rowcount = curs.fetchone()[0]
+	rows = curs.execute(columns('caches', CacheColumns) + where +
+		(' order by Code' if stream else ''))
+    else:
+	curs.execute(columns('caches', CacheColumns) + where)
+	rows = curs.fetchall()
+	rowcount = len(rows)
+    return rowcount, rows
 
-    curs = conn.cursor()
-    curs.execute('PRAGMA cache_size=20000')
-    curs.execute('select * from caches')
-    rows = curs.fetchall()
-    rowcount = len(rows)
-    for row in rows:
-	recordnum += 1
-	if recordnum % 10 == 0:
-	    print "\rNow processing: %d of %d points" % (recordnum, rowcount),
-	print >>outf, processCache(row)
+def queryWaypoints(curs, stream, filtered):
+    """
+    Get the number of additional waypoints and the waypoints to process,
+    as queryCaches does for caches. Each comes with the SmartName of its
+    cache as ParentSmart, so that nothing has to be kept from the caches
+    for them.
+    """
+    where = selected('waypoints.cParent', filtered)
+    curs.execute('select count(*) from waypoints' + where)
+    rowcount = curs.fetchone()[0]
+    rows = curs.execute('select %s, caches.SmartName as ParentSmart '
+	    'from waypoints left join caches on caches.Code = waypoints.cParent'
+	    % ', '.join(['waypoints.' + col for col in WaypointColumns]) + where +
+	    (' order by waypoints.cCode' if stream else ''))
+    if not stream:
+	rows = rows.fetchall()
+    return rowcount, rows
+
+def selectCaches(convs, dbnames, outdir, outname, areas):
+    """
+    Pick the caches to take from each database, unless all of them are
+    taken: those in the areas, if any, and when several databases are
+    merged, only the most recently updated copy of each cache. The picked
+    caches go in the selection table of a spatial index for each database.
+    """
+    if not areas and len(convs) == 1:
+	return
 
-    print "\rNow processing: %d of %d points" % (recordnum, rowcount),
-    print "\nDone"
+    indexes = []
+    for conv, dbname in zip(convs, dbnames):
+	if len(convs) == 1:
+	    indexfile = '%s/%s GSAK.index' % (outdir, outname)
+	else:
+	    indexfile = '%s/%s %s GSAK.index' % (outdir, outname, dbname)
+	index = spatial.SpatialIndex(indexfile)
+	if areas:
+	    if index.update(conv.conn, conv.dbfile):
+		show_message('Built spatial index %s' % indexfile)
+	    msg = 'Picked %d caches by area' % index.select(areas)
+	    if len(convs) > 1:
+		msg += ' in %s' % dbname
+	    show_message(msg)
+	indexes.append(index)
+
+    if len(convs) > 1:
+	# GSAK dates are YYYY-MM-DD, so they sort as strings. The date of the
+	# last GPX or API update comes first, then the date of the last
+	# change. On a tie, the database given first wins.
+	newest = {}
+	copies = 0
+	for i, conv in enumerate(convs):
+	    picked = None
+	    if areas:
+		picked = indexes[i].selection()
+	    curs = conv.conn.cursor()
+	    curs.execute('select Code, LastGPXDate, Changed from caches')
+	    for code, gpxdate, changed in curs:
+		if picked is not None and code not in picked:
+		    continue
+		copies += 1
+		updated = (gpxdate or '', changed or '')
+		if code not in newest or updated > newest[code][0]:
+		    newest[code] = (updated, i)
+	owned = [[] for conv in convs]
+	for code, (updated, i) in newest.iteritems():
+	    owned[i].append(code)
+	for index, codes in zip(indexes, owned):
+	    index.choose(codes)
+	show_message('Merged %d caches, skipped %d older copies' % (
+	    len(newest), copies - len(newest)))
+
+    for conv, index in zip(convs, indexes):
+	index.close()
+	conv.useIndex(index.fname)
+
+def write_db(conv, output, jobs, profile, frags, pipeline, shardOf):
+    """
+    Render the caches and additional waypoints of one database to output,
+    as write_gpx does, each to the shard given by shardOf for its key in
+    the plan from planOutput.
+    """
+    pool = None
+    if jobs > 1:
+	pool = multiprocessing.Pool(jobs, init_worker,
+		(conv.workerArgs(), profile))
+
+    reader = None
+    if pipeline:
+	logIds = None
+	if pool is None and not conv.stream:
+	    # Log texts are only needed here if rendering is done here. The
+	    # ids of the logs come from the prefetched logs table, which
+	    # has to be loaded before the reader can look at it.
+	    conv.logsTable.load()
+	    logIds = conv.logsTable.logIds
+	reader = ReadAhead(conv, logIds)
+	reader.start()
 
-    recordnum = 0
+    try:
+	curs = conv.conn.cursor()
+	if reader is not None:
+	    kind, rowcount = reader.get()
+	    rows = reader.rows()
+	else:
+	    rowcount, rows = queryCaches(curs, conv.stream, conv.areaFilter)
+	write_rows(output, conv.caches(rows, pool, frags), rowcount, 'points',
+		shardOf)
+
+	rowcount, rows = queryWaypoints(curs, conv.stream, conv.areaFilter)
+	write_rows(output, conv.waypoints(rows, pool, frags), rowcount,
+		'additional points', lambda code: shardOf('waypoints/' + code))
+    except:
+	# Don't leave worker processes or threads behind when --watch
+	# carries on.
+	if pool is not None:
+	    pool.terminate()
+	if reader is not None:
+	    reader.stop()
+	raise
+
+    if pool is not None:
+	pool.close()
+	pool.join()
+
+def write_gpx(convs, dbnames, files, outdir, outname, jobs, incremental,
+	profile, tilesize, maxpoints, areas, pipeline):
+    """
+    Write the GPX output for the databases of the Converters, split into
+    shards if tilesize or maxpoints is set and limited to the given areas
+    if any. With several databases, each cache is rendered once, from the
+    database with its most recent copy. With pipeline, caches are read
+    ahead and waypoints written in threads of their own while rendering
+    goes on.
+    """
+    selectCaches(convs, dbnames, outdir, outname, areas)
 
-    curs.execute('select * from waypoints')
-    rows = curs.fetchall()
-    rowcount = len(rows)
-    for row in rows:
-	recordnum += 1
-	if recordnum % 10 == 0:
-	    print "\rNow processing: %d of %d additional points" % (recordnum, rowcount),
-	print >>outf, processWaypoint(row)
+    plan, files.bounds = planOutput(convs, tilesize, maxpoints)
+    if plan is not None:
+	shardOf = plan.__getitem__
+    else:
+	files.open('')
+	shardOf = lambda key: ''
+
+    frags = None
+    if incremental:
+	frags = files.fragmentCache()
 
-    print "\rNow processing: %d of %d additional points" % (recordnum, rowcount),
-    print "\nDone"
+    output = files
+    if pipeline:
+	output = WriteBehind(files)
+	output.start()
 
-    print >>outf, "</gpx>"
-    outf.close()
+    try:
+	for conv in convs:
+	    write_db(conv, output, jobs, profile, frags, pipeline, shardOf)
+	if output is not files:
+	    output.finish()
+    except:
+	if output is not files:
+	    output.stop()
+	raise
+
+    show_message('Log text cache: %d hits, %d misses' % (
+	    sum([conv.logMemo.cache.hits for conv in convs]),
+	    sum([conv.logMemo.cache.misses for conv in convs])))
+    show_message('Sanitized text memo: %d hits, %d misses' % (
+	    sum([conv.textMemo.cache.hits for conv in convs]),
+	    sum([conv.textMemo.cache.misses for conv in convs])))
+
+    fingerprints = None
+    if frags is not None:
+	frags.evictUnused()
+	show_message('Reused %d stored points, rendered %d, dropped %d' % (
+		frags.hits, frags.misses, frags.evicted))
+	if plan is not None:
+	    fingerprints = frags.fingerprints('caches')
+	    for code, fp in frags.fingerprints('waypoints').items():
+		fingerprints['waypoints/' + code] = fp
+	frags.close()
+
+    if plan is None:
+	files.close()
+	return
+
+    # A shard needs to be written again if any of its waypoints has
+    # changed since its file was last written, or if it has gained or lost
+    # any. The digest of each shard covers the fingerprints of its
+    # waypoints, rather than whether they changed since the fragment cache
+    # was last updated, which may have been by a run with other shards or
+    # one that failed to write its files. That can only be told with
+    # --incremental.
+    members = shards.members(plan, fingerprints,
+	    os.path.basename(files.gpxName('')))
+    shardfname = '%s/%s GSAK.shards' % (outdir, outname)
+    oldmembers = {}
+    if os.path.exists(shardfname):
+	oldmembers = json.load(open(shardfname))
+    keep = ()
+    if incremental:
+	keep = [shard for shard in members
+		if oldmembers.get(shard) == members[shard]]
+    written = files.close(keep)
+    for shard in set(oldmembers) - set(members):
+	files.remove(shard)
+    f = open(shardfname, 'w')
+    json.dump(members, f, indent=1, sort_keys=True)
+    f.close()
+    msg = 'Wrote %d of %d shards' % (len(written), len(members))
+    if written:
+	msg += ': ' + ' '.join(written)
+    show_message(msg)
 
-    writeicon('%s/%s GSAK.bmp' % (outdir, outname), nuvifiles.cacheBMP)
-    writeicon('%s/%s GSAK.jpg' % (outdir, outname), nuvifiles.cacheJPG)
 
+def init_db_worker(queue):
+    """
+    Set up a process that converts whole databases.
+    """
+    global progressQueue
+    progressQueue = queue
+
+def process_db_job(args):
+    """
+    Convert one database in a worker process. Returns the exit status.
+    """
+    global progressName
+    progressName = args[1]
+    try:
+	process_db(*args)
+    except SystemExit, e:
+	return e.code
+    except Exception:
+	show_message(traceback.format_exc())
+	return 1
+    return 0
+
+def process_parallel(jobs, parallel):
+    """
+    Convert several databases at once, one per worker process. jobs is a
+    list of process_db argument tuples. Returns the exit status: non-zero
+    if any database failed.
+    """
+    queue = multiprocessing.Queue()
+    pool = multiprocessing.Pool(min(parallel, len(jobs)), init_db_worker,
+	    (queue, ))
+    pending = [(args[1], pool.apply_async(process_db_job, (args, )))
+	    for args in jobs]
+    pool.close()
+
+    status = {}
+    exitcode = 0
+    shown = ''
+    while pending:
+	# Wait a little for news from the workers, then take everything
+	# that has arrived.
+	try:
+	    item = queue.get(True, 0.5)
+	    while True:
+		name, kind, msg = item
+		if kind == 'progress':
+		    status[name] = msg
+		elif kind == 'error':
+		    sys.stdout.write('\r%s\r' % (' ' * len(shown)))
+		    sys.stdout.flush()
+		    print >> sys.stderr, '%s: %s' % (name, msg)
+		    shown = ''
+		else:
+		    print '\r%s\r%s: %s' % (' ' * len(shown), name, msg)
+		    shown = ''
+		item = queue.get_nowait()
+	except Queue.Empty:
+	    pass
+
+	for name, result in pending[:]:
+	    if result.ready():
+		pending.remove((name, result))
+		status.pop(name, None)
+		code = result.get()
+		print '\r%s\r%s: %s' % (' ' * len(shown), name,
+			'Done' if code == 0 else 'FAILED')
+		shown = ''
+		exitcode = exitcode or code
+
+	line = '; '.join(['%s: %s' % (name, status[name])
+	    for name, result in pending if name in status])
+	if line != shown:
+	    print '\r%s\r%s' % (' ' * len(shown), line),
+	    shown = line
+
+    print
+    pool.join()
+    return exitcode
+
+class DbWatcher:
+    """
+    Tell whether a GSAK database has changed. SQLite does not always change
+    the modification time of the database file itself, for example when it
+    writes to a -wal file, so PRAGMA data_version is checked as well. That
+    changes whenever another connection commits to the database.
+    """
+    def __init__(self, dbfile):
+	self.dbfile = dbfile
+	self.conn = None
+	self.files = gsakdb.fileStates(dbfile)
+	self.version = self.dataVersion()
+
+    def dataVersion(self):
+	try:
+	    if self.conn is None:
+		self.conn = gsakdb.connect(self.dbfile)
+	    return self.conn.execute('PRAGMA data_version').fetchone()[0]
+	except sqlite3.Error:
+	    self.conn = None
+	    return None
+
+    def changed(self):
+	files = gsakdb.fileStates(self.dbfile)
+	if files != self.files:
+	    # The file may have been replaced, so look at the new one.
+	    self.files = files
+	    self.conn = None
+	    self.version = self.dataVersion()
+	    return True
+	version = self.dataVersion()
+	if version != self.version:
+	    self.version = version
+	    return True
+	return False
+
+def watch(jobs, interval):
+    """
+    Convert the databases, then check them for changes every interval
+    seconds and convert those that have changed again. That waits until a
+    database has stopped changing, so that a GSAK refresh is not picked up
+    halfway. Runs until interrupted.
+    """
+    watchers = []
+    for args in jobs:
+	# Look at the databases first, so that changes made while they are
+	# converted are picked up at the first check.
+	watchers.append([DbWatcher(gsakdb.dbPath(args[3], dbname))
+	    for dbname in dbNames(args[0])])
+	process_db(*args)
+
+    show_message('Watching for changes. Press Ctrl-C to stop.')
+    pending = set()
+    try:
+	while True:
+	    time.sleep(interval)
+	    for i, dbwatchers in enumerate(watchers):
+		# Check every database of a merge, so that none of them is
+		# seen as changed again later.
+		if [w for w in dbwatchers if w.changed()]:
+		    pending.add(i)
+		elif i in pending:
+		    pending.remove(i)
+		    start = time.time()
+		    try:
+			process_db(*jobs[i])
+		    except (sqlite3.Error, SystemExit), e:
+			# GSAK may still have the database locked. Try again
+			# at the next check.
+			show_message('Error reading %s: %s' % (
+			    ', '.join([w.dbfile for w in dbwatchers]), e))
+			pending.add(i)
+			continue
+		    show_message('Updated in %.1f s' % (time.time() - start))
+    except KeyboardInterrupt:
+	print
+
+def parseNumbers(parser, option, s, count):
+    """
+    Parse a comma-separated list of count numbers given to an option.
+    """
+    try:
+	values = [float(x) for x in s.split(',')]
+    except ValueError:
+	values = []
+    if len(values) != count:
+	parser.error('%s needs %d comma-separated numbers' % (option, count))
+    return values
 
 def main():
     parser = OptionParser(usage = """Usage: %prog [options] dbname[=outname] [dbname[=outname] ...]
@@ -658,6 +2484,72 @@ def main():
 	    help='Output directory.')
     parser.add_option('-g', '--gsak-folder', dest='gsakfolder', default='gsak',
 	    help='GSAK folder name.')
+    parser.add_option('-s', '--stream', dest='stream', action='store_true',
+	    default=False,
+	    help='Read tables in cache code order instead of prefetching '
+	    'them. Uses much less memory on large databases.')
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=1,
+	    help='Number of processes to render waypoints with.')
+    parser.add_option('-i', '--incremental', dest='incremental',
+	    action='store_true', default=False,
+	    help='Keep rendered waypoints in a cache file next to the GPX '
+	    'file and only render waypoints that have changed since the '
+	    'last run.')
+    parser.add_option('-P', '--parallel', dest='parallel', type='int',
+	    default=1,
+	    help='Number of databases to process at the same time, each in '
+	    'its own process. --jobs is ignored when this is more than 1.')
+    parser.add_option('-m', '--log-cache', dest='logcache', type='int',
+	    default=LogCacheSize,
+	    help='Memory cap for cached log texts in MB, per process. '
+	    'Default: %default.')
+    parser.add_option('-z', '--gzip', dest='compress', action='store_true',
+	    default=False,
+	    help='Write gzipped output to outname GSAK.gpx.gz instead.')
+    parser.add_option('-M', '--merge', dest='merge', metavar='OUTNAME',
+	    help='Merge all the databases into one output, OUTNAME GSAK.gpx. '
+	    'Caches that are in more than one database are taken from the one '
+	    'where they were updated last.')
+    parser.add_option('--gpi', dest='gpi', action='store_true',
+	    default=False,
+	    help='Write Garmin GPI files, outname GSAK.gpi, ready to copy to '
+	    'the device without going through POI Loader.')
+    parser.add_option('--profile', dest='profile', action='store_true',
+	    default=False,
+	    help='Time each stage of processing and save a report to '
+	    'outname GSAK.profile.json.')
+    parser.add_option('-t', '--tile', dest='tilesize', type='float',
+	    help='Split the output into one GPX file per tile of this many '
+	    'degrees of latitude and longitude.')
+    parser.add_option('-n', '--max-points', dest='maxpoints', type='int',
+	    help='Split the output into GPX files of at most this many '
+	    'points, by dividing the area into smaller and smaller tiles.')
+    parser.add_option('-b', '--box', dest='box',
+	    help='Only take caches inside this area, given as '
+	    'south,west,north,east in degrees.')
+    parser.add_option('-r', '--near', dest='near', action='append',
+	    default=[],
+	    help='Only take caches within some distance of a point, given as '
+	    'lat,lon,km. Can be given several times, for example for points '
+	    'along a route.')
+    parser.add_option('-p', '--pipeline', dest='pipeline',
+	    action='store_true', default=False,
+	    help='Read from the database and write the GPX file in threads of '
+	    'their own while waypoints are rendered. Helps most when the '
+	    'database is not in the disk cache.')
+    parser.add_option('--db-profile', dest='dbprofile', default='default',
+	    choices=sorted(gsakdb.Profiles),
+	    help='SQLite tuning: %s. Default: %%default.' %
+	    ', '.join(sorted(gsakdb.Profiles)))
+    parser.add_option('--immutable', dest='immutable', action='store_true',
+	    default=False,
+	    help='Open databases without locking. Only use this if GSAK is '
+	    'not running.')
+    parser.add_option('-w', '--watch', dest='watch', type='float',
+	    metavar='SECONDS',
+	    help='Keep running, check the databases for changes every this '
+	    'many seconds and convert the ones that changed again. Implies '
+	    '--incremental.')
 
     (options, args) = parser.parse_args()
 
@@ -665,13 +2557,61 @@ def main():
 	parser.print_help()
 	sys.exit(1)
 
+    if options.gpi and options.compress:
+	parser.error('--gzip cannot be used with --gpi')
+
+    if options.watch is not None:
+	if options.watch <= 0:
+	    parser.error('--watch needs a positive number of seconds')
+	if options.immutable:
+	    parser.error('--watch cannot be used with --immutable')
+	if options.parallel > 1:
+	    parser.error('--watch cannot be used with --parallel')
+	options.incremental = True
+
+    areas = []
+    if options.box:
+	south, west, north, east = parseNumbers(parser, '--box', options.box,
+		4)
+	areas.append(spatial.Box(south, west, north, east))
+    for near in options.near:
+	lat, lon, km = parseNumbers(parser, '--near', near, 3)
+	areas.append(spatial.Circle(lat, lon, km))
+
+    if options.merge is not None and [arg for arg in args if '=' in arg]:
+	parser.error('--merge takes database names without =outname')
+
+    jobs = []
     for arg in args:
         # name=name2 means read DB name but output as name2.
         dbname = arg
         outname = arg
         if '=' in arg:
             dbname, outname = arg.split('=', 2)
-	process_db(dbname, outname, options.outdir, options.gsakfolder)
+	jobs.append((dbname, outname, options.outdir, options.gsakfolder,
+	    options.stream, options.jobs, options.incremental,
+	    options.logcache, options.compress, options.profile,
+	    options.dbprofile, options.immutable, options.tilesize,
+	    options.maxpoints, areas, options.pipeline, options.gpi))
+
+    if options.merge is not None:
+	dbnames = []
+	for arg in args:
+	    if arg not in dbnames:
+		dbnames.append(arg)
+	jobs = [(dbnames, options.merge) + jobs[0][2:]]
+
+    if options.watch is not None:
+	watch(jobs, options.watch)
+	return
+
+    if options.parallel > 1 and len(jobs) > 1:
+	# Worker processes cannot have their own process pools.
+	jobs = [jobargs[:5] + (1, ) + jobargs[6:] for jobargs in jobs]
+	sys.exit(process_parallel(jobs, options.parallel))
+
+    for args in jobs:
+	process_db(*args)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+records.py - Compact storage for rows kept in memory.
+
+A sqlite3.Row is an object that points to a tuple of values, and every
+value is a string of its own, even if the same log type, finder name or
+date turns up thousands of times. Here, a group of rows that is looked up
+together, such as the logs of one cache, is packed into one flat tuple of
+values, with short strings interned so that each distinct value is stored
+once.
+
+Rows are unpacked into dicts when they are rendered. Dicts are larger,
+but they only live while a cache is being rendered, and looking up a column
+in a dict is as fast as in a sqlite3.Row. Where only one column is needed,
+like the types of the last few logs, it is read from the packed values
+without unpacking anything.
+"""
+
+import itertools
+
+# Only strings up to this length are shared. Repeated values are nearly
+# always short ones, like log types, dates and "TFTC", while longer texts
+# are mostly unique and would only fill up the table of shared strings.
+ShareLimit = 64
+
+def share(value):
+    """
+    Get the stored copy of a string if the same string has been seen
+    before. Anything other than a byte string is returned as is.
+    """
+    if type(value) is str and len(value) <= ShareLimit:
+	return intern(value)
+    return value
+
+def pack(rows):
+    """
+    Pack rows into one tuple of values. Does the same as share, but
+    without a call for each value, since this is where most values go.
+    """
+    return tuple([intern(value)
+	if type(value) is str and len(value) <= ShareLimit else value
+	for row in rows for value in row])
+
+def unpack(columns, values):
+    """
+    Get the rows back from pack, as dicts of value by column name.
+    """
+    n = len(columns)
+    izip = itertools.izip
+    return [dict(izip(columns, values[i:i + n]))
+	for i in xrange(0, len(values), n)]
+
+def column(columns, values, name, count=None):
+    """
+    Get the values of one column from pack, for the first count rows if
+    count is given, without unpacking the rows.
+    """
+    n = len(columns)
+    return values[columns.index(name):None if count is None else count * n:n]
+
+# vim:set tw=0:
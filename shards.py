@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""
+shards.py - Split caches into geographic shards.
+
+A shard is a tile of the map, optionally split into quarters, then quarters
+of those and so on, until no piece holds more than a given number of
+points. Shards are named with letters only, because POI Loader turns
+waypoints from files with numbers in their names into speed alerts.
+"""
+
+import math
+import hashlib
+
+# Never split a tile more often than this, in case there are more points
+# at one spot than fit in a shard.
+MaxDepth = 16
+
+def letters(n, width):
+    """
+    Write a number in base 26 with the letters A to Z, padded to width.
+    """
+    s = ''
+    while n > 0 or len(s) < width:
+	s = chr(ord('A') + n % 26) + s
+	n //= 26
+    return s
+
+def tile(lat, lon, size):
+    """
+    Get the name and the bounds (south, north, west, east) of the tile of
+    the given size in degrees that a point falls in.
+    """
+    i = int(math.floor((lat + 90) / size))
+    j = int(math.floor((lon + 180) / size))
+    name = letters(i, len(letters(int(180 / size), 1))) + \
+	    letters(j, len(letters(int(360 / size), 1)))
+    return name, (-90 + i * size, -90 + (i + 1) * size,
+	    -180 + j * size, -180 + (j + 1) * size)
+
+def split(plan, name, points, bounds, maxpoints, depth):
+    """
+    Put points in the shard name, or if there are too many of them, split
+    the shard into quarters: A (south-west), B (south-east), C (north-west)
+    and D (north-east).
+    """
+    if not maxpoints or depth >= MaxDepth or \
+	    sum([p[3] for p in points]) <= maxpoints:
+	for p in points:
+	    plan[p[0]] = name
+	return
+
+    south, north, west, east = bounds
+    midlat = (south + north) / 2.0
+    midlon = (west + east) / 2.0
+    quarters = [[], [], [], []]
+    for p in points:
+	quarters[(p[1] >= midlat) * 2 + (p[2] >= midlon)].append(p)
+    boxes = [(south, midlat, west, midlon), (south, midlat, midlon, east),
+	    (midlat, north, west, midlon), (midlat, north, midlon, east)]
+    for i in range(4):
+	if quarters[i]:
+	    split(plan, name + 'ABCD'[i], quarters[i], boxes[i], maxpoints,
+		    depth + 1)
+
+def plan(points, tilesize=None, maxpoints=None):
+    """
+    Assign points to shards. points is a list of (key, latitude, longitude,
+    weight), where the weight is the number of waypoints the key stands
+    for. Returns a dict of shard name by key. Without a tile size,
+    everything starts out in one shard named ''.
+    """
+    tiles = {}
+    for p in points:
+	if tilesize:
+	    name, bounds = tile(p[1], p[2], tilesize)
+	else:
+	    name, bounds = '', (-90.0, 90.0, -180.0, 180.0)
+	tiles.setdefault((name, bounds), []).append(p)
+
+    result = {}
+    for (name, bounds), tilepoints in tiles.items():
+	split(result, name, tilepoints, bounds, maxpoints, 0)
+    return result
+
+def members(plan, fingerprints=None, salt=''):
+    """
+    Get a digest of the contents of each shard, to tell whether a shard
+    has changed since the last run: its keys, the fingerprint of each
+    from fingerprints if given, and salt, which names the kind of file.
+    """
+    keys = {}
+    for key, name in plan.items():
+	if fingerprints is not None:
+	    key = '%s %s' % (key, fingerprints.get(key, ''))
+	keys.setdefault(name, []).append(key)
+    return dict([(name,
+	hashlib.sha1('\n'.join([salt] + sorted(k))).hexdigest())
+	for name, k in keys.items()])
+
+# vim:set tw=0:
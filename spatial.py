@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+
+"""
+spatial.py - Pick caches by area with a spatial index.
+
+The index is kept in a sidecar SQLite file, since GSAK databases are only
+ever opened read-only. It is rebuilt whenever the GSAK database changes,
+as told by gsakdb.fileStates.
+The codes of the caches picked for a run are stored in the sidecar as
+well, in the selection table, so that queries on the GSAK database can
+attach the sidecar and join against them.
+"""
+
+import math
+import sqlite3
+import gsakdb
+
+EarthRadius = 6371.0088
+
+# Change this whenever the layout of the index changes.
+IndexVersion = '1'
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Get the great circle distance between two points in km.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+	    math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EarthRadius * math.asin(min(1.0, math.sqrt(a)))
+
+class Box:
+    """
+    An area bounded by latitude and longitude. If west is greater than east,
+    the box crosses the 180th meridian.
+    """
+    def __init__(self, south, west, north, east):
+	self.south = south
+	self.west = west
+	self.north = north
+	self.east = east
+
+    def boxes(self):
+	"""
+	Get the box as (south, north, west, east) tuples that don't cross
+	the 180th meridian.
+	"""
+	if self.west <= self.east:
+	    return [(self.south, self.north, self.west, self.east)]
+	return [(self.south, self.north, self.west, 180.0),
+		(self.south, self.north, -180.0, self.east)]
+
+    def contains(self, lat, lon):
+	if not self.south <= lat <= self.north:
+	    return False
+	if self.west <= self.east:
+	    return self.west <= lon <= self.east
+	return lon >= self.west or lon <= self.east
+
+class Circle:
+    """
+    The area within radius km of a point.
+    """
+    def __init__(self, lat, lon, radius):
+	self.lat = lat
+	self.lon = lon
+	self.radius = radius
+
+    def boxes(self):
+	dlat = math.degrees(self.radius / EarthRadius)
+	south = max(-90.0, self.lat - dlat)
+	north = min(90.0, self.lat + dlat)
+	coslat = math.cos(math.radians(max(abs(south), abs(north))))
+	if north >= 90.0 or south <= -90.0 or dlat / coslat >= 180.0:
+	    return [(south, north, -180.0, 180.0)]
+	dlon = dlat / coslat
+	west = self.lon - dlon
+	east = self.lon + dlon
+	if west < -180.0:
+	    west += 360.0
+	if east > 180.0:
+	    east -= 360.0
+	return Box(south, west, north, east).boxes()
+
+    def contains(self, lat, lon):
+	return distance(self.lat, self.lon, lat, lon) <= self.radius
+
+class SpatialIndex:
+    """
+    Sidecar file with an R-tree of cache positions. If SQLite has no R-tree
+    support, a plain table with an index on latitude is used instead.
+    """
+    def __init__(self, fname):
+	self.fname = fname
+	self.conn = sqlite3.connect(fname)
+	self.conn.execute(
+		'create table if not exists meta (name text primary key, value text)')
+	self.conn.execute(
+		'create table if not exists selection (Code text primary key)')
+
+    def stamp(self, dbfile):
+	return '%s/%r' % (IndexVersion, gsakdb.fileStates(dbfile))
+
+    def update(self, conn, dbfile):
+	"""
+	Rebuild the index from the caches table if the GSAK database has
+	changed since it was built.
+	"""
+	stamp = self.stamp(dbfile)
+	row = self.conn.execute(
+		"select value from meta where name = 'stamp'").fetchone()
+	if row is not None and row[0] == stamp:
+	    return False
+
+	db = self.conn
+	db.execute('drop table if exists positions')
+	db.execute('drop table if exists rtree')
+	db.execute("""create table positions (id integer primary key,
+	    Code text, lat real, lon real)""")
+	try:
+	    db.execute("""create virtual table rtree using rtree(id,
+		minlat, maxlat, minlon, maxlon)""")
+	except sqlite3.OperationalError:
+	    db.execute("""create table rtree (id integer primary key,
+		minlat real, maxlat real, minlon real, maxlon real)""")
+	    db.execute('create index rtree_lat on rtree (minlat)')
+
+	curs = conn.cursor()
+	curs.execute('select rowid, Code, Latitude, Longitude from caches')
+	for row in curs:
+	    try:
+		lat = float(row[2])
+		lon = float(row[3])
+	    except ValueError:
+		continue
+	    db.execute('insert into positions values (?,?,?,?)',
+		    (row[0], row[1], lat, lon))
+	    db.execute('insert into rtree values (?,?,?,?,?)',
+		    (row[0], lat, lat, lon, lon))
+	db.execute('insert or replace into meta values (?,?)',
+		('stamp', stamp))
+	db.commit()
+	return True
+
+    def select(self, areas):
+	"""
+	Fill the selection table with the caches in any of the areas.
+	Returns the number of caches selected.
+	"""
+	codes = set()
+	for area in areas:
+	    for south, north, west, east in area.boxes():
+		curs = self.conn.execute("""select Code, lat, lon
+		    from positions where id in (select id from rtree
+		    where maxlat >= ? and minlat <= ?
+		    and maxlon >= ? and minlon <= ?)""",
+		    (south, north, west, east))
+		for code, lat, lon in curs:
+		    if area.contains(lat, lon):
+			codes.add(code)
+	self.choose(codes)
+	return len(codes)
+
+    def choose(self, codes):
+	"""
+	Replace the selection with the given cache codes.
+	"""
+	self.conn.execute('delete from selection')
+	self.conn.executemany('insert into selection values (?)',
+		[(code, ) for code in codes])
+	self.conn.commit()
+
+    def selection(self):
+	"""
+	Get the codes of the caches in the selection, as a set.
+	"""
+	return set([row[0] for row in
+	    self.conn.execute('select Code from selection')])
+
+    def close(self):
+	self.conn.close()
+
+# vim:set tw=0:
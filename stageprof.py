@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+stageprof.py - Time how long a program spends in each of its stages.
+
+Functions are assigned to stages by wrapping them, so that nothing is
+measured, and nothing slows down, unless profiling is turned on. Stages may
+be nested: each one gets its total time, including the stages called from
+it, and its own time, excluding those. Stages may be timed in several
+threads at once; nesting is tracked for each thread.
+"""
+
+import sys
+import heapq
+import functools
+import threading
+from timeit import default_timer as timer
+
+def peakMemory():
+    """
+    Get the peak memory use in KB of this process and of its finished
+    child processes, or None where that is not available.
+    """
+    try:
+	import resource
+    except ImportError:
+	return None, None
+    # ru_maxrss is in bytes on OS X and in KB elsewhere.
+    scale = 1024 if sys.platform == 'darwin' else 1
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+	    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+class StageProfiler:
+    """
+    Collect time and call counts by stage, and the top slowest calls of
+    stages wrapped with a key function.
+    """
+    def __init__(self, top=20):
+	self.top = top
+	self.lock = threading.Lock()
+	self.reset()
+
+    def reset(self):
+	self.stages = {}
+	self.slowest = []
+	# Time spent in nested stages, for each stage being timed in each
+	# thread.
+	self.local = threading.local()
+
+    def wrap(self, func, stage, keyfunc=None):
+	"""
+	Return a function that calls func and adds the time to stage. If
+	keyfunc is given, it is called with the arguments to get a name for
+	the call in the list of slowest calls.
+	"""
+	@functools.wraps(func)
+	def timed(*args):
+	    stack = self.local.__dict__.setdefault('nested', [])
+	    stack.append(0.0)
+	    start = timer()
+	    try:
+		return func(*args)
+	    finally:
+		elapsed = timer() - start
+		nested = stack.pop()
+		if stack:
+		    stack[-1] += elapsed
+		self.add(stage, elapsed, elapsed - nested, 1)
+		if keyfunc is not None:
+		    self.addSlow(elapsed, stage, keyfunc(*args))
+	return timed
+
+    def add(self, stage, total, own, calls):
+	with self.lock:
+	    s = self.stages.get(stage)
+	    if s is None:
+		self.stages[stage] = [total, own, calls]
+	    else:
+		s[0] += total
+		s[1] += own
+		s[2] += calls
+
+    def addSlow(self, elapsed, stage, key):
+	item = (elapsed, stage, key)
+	with self.lock:
+	    if len(self.slowest) < self.top:
+		heapq.heappush(self.slowest, item)
+	    elif item > self.slowest[0]:
+		heapq.heapreplace(self.slowest, item)
+
+    def take(self):
+	"""
+	Get the numbers collected so far and start over. For sending them
+	from a worker process to the parent.
+	"""
+	stats = (self.stages, self.slowest)
+	self.stages = {}
+	self.slowest = []
+	return stats
+
+    def merge(self, stats):
+	"""
+	Add numbers from take.
+	"""
+	stages, slowest = stats
+	for stage, (total, own, calls) in stages.items():
+	    self.add(stage, total, own, calls)
+	for elapsed, stage, key in slowest:
+	    self.addSlow(elapsed, stage, key)
+
+    def report(self):
+	"""
+	Get the numbers as a dict, ready to be saved as JSON.
+	"""
+	self_kb, children_kb = peakMemory()
+	return {
+	    'stages': dict([(stage, {'total': total, 'self': own,
+		'calls': calls})
+		for stage, (total, own, calls) in self.stages.items()]),
+	    'slowest': [{'stage': stage, 'key': key, 'time': elapsed}
+		for elapsed, stage, key in sorted(self.slowest, reverse=True)],
+	    'peak_memory_kb': self_kb,
+	    'peak_memory_children_kb': children_kb,
+	}
+
+# vim:set tw=0: